@@ -13,7 +13,6 @@ import datetime
 
 from pprint import pprint
 from colorama import init
-from github import Github, Requester
 from oauth2client.tools import argparser as youtube_argparser
 from termcolor import colored, cprint
 
@@ -23,7 +22,13 @@ sys.path.append(os.path.abspath(os.path.join(THIS_DIRECTORY, '..')))
 from lib.youtube import get_authenticated_service, get_videos, \
     parse_videos_from_json, get_latest_videos_of_channel
 
-from lib.github import GITHUB_API_KEY, LANGUAGES
+from lib.github import LANGUAGES, GITHUB_PROJECTS_ACCEPT, get_github, \
+    request_api, request_creation
+from lib.languages import get_issue_templates
+from lib.issues import get_issue_index, get_issue_title
+from lib.board import get_board_index, get_cards_of_column, \
+    get_issue_number
+from lib.mutations import MutationExecutor
 
 # use Colorama to make Termcolor work on all platforms
 init()
@@ -37,6 +42,63 @@ def _s(int_or_list):
     return '' if int_or_list == 1 else 's'
 
 
+def create_issue(executor, repository, language, video, title, body, labels,
+                 column_id):
+    """
+    Creates the issue, and then submits the creation of its card.
+    :return: the number of the issue
+    """
+    issue_index = get_issue_index(repository)
+
+    def find_issue():
+        issue = issue_index.refresh().find(language, video)
+        if issue is None:
+            return None
+        status, headers, data = request_api(
+            "GET", "/repos/%s/issues/%d" % (repository, issue.number)
+        )
+        return data
+
+    data = request_creation(
+        "/repos/%s/issues" % repository,
+        {'title': title, 'body': body, 'labels': labels},
+        find_issue
+    )
+    issue_index.add_data(data)
+    executor.submit(
+        "Create a card for issue #%d" % data['number'],
+        create_card, data, column_id
+    )
+    return data['number']
+
+
+def create_card(issue_data, column_id):
+    """
+    Creates the card of the issue in the column.
+    :return: the id of the card
+    """
+    def find_card():
+        for card_data in get_cards_of_column(column_id):
+            if get_issue_number(card_data.get('content_url')) \
+                    == issue_data['number']:
+                return card_data
+        return None
+
+    # Ok, this is a total hack that may break at any point,
+    # because the Cards API is a dev-preview only.
+    data = request_creation(
+        "/projects/columns/%d/cards" % column_id,
+        {
+            'content_id': issue_data['id'],
+            'content_type': 'Issue'
+        },
+        find_card,
+        {"Accept": GITHUB_PROJECTS_ACCEPT}
+    )
+    get_board_index().set(issue_data['number'], data['id'], column_id)
+    return data['id']
+
+
 ###############################################################################
 
 
@@ -80,7 +142,6 @@ if __name__ == "__main__":
         help="""
         Identifier⋅s of the YouTube video⋅s for which to create issues.
         When you provide this option, the --channel option is ignored.
-        You cannot provide more than 50 video ids to this parameter.
         """
     )
 
@@ -131,49 +192,27 @@ if __name__ == "__main__":
     print("Collecting issues of repository %s..."
           % colored(args.repository, "yellow"))
 
-    gh = Github(GITHUB_API_KEY)
-    repo = gh.get_repo(args.repository)
-
-    # The Projects API is still in development
-    # - https://developer.github.com/v3/projects
-    # - It's not supported by the python lib yet
-    # - We need to provide a special "Accept" header
-    # So, we hack in our own support ; it's dirty but it works.
-    # Be warned : it may break at any moment -_-
-    GITHUB_ACCEPT = "application/vnd.github.inertia-preview+json"
-    rq = Requester.Requester(
-        GITHUB_API_KEY, None, "https://api.github.com", 10, None, None,
-        'PyGithub/Python', 30, False
-    )
+    repo = get_github().get_repo(args.repository)
 
     # Useful to get the IDs of the Projects
-    # headers, data = rq.requestJsonAndCheck(
-    #     "GET",
-    #     "/repos/%s/projects" % args.repository,
-    #     None,
-    #     {"Accept": GITHUB_ACCEPT}k
+    # headers, data = request_projects_api(
+    #     "GET", "/repos/%s/projects" % args.repository
     # )
     # pprint(data)
 
     # Useful to get the IDs of the Columns
-    # headers, data = rq.requestJsonAndCheck(
-    #     "GET",
-    #     "/projects/%s/columns" % '373391',
-    #     None,
-    #     {"Accept": GITHUB_ACCEPT}
+    # headers, data = request_projects_api(
+    #     "GET", "/projects/%s/columns" % '373391'
     # )
     # pprint(data)
 
     # List cards of a Column
-    # headers, data = rq.requestJsonAndCheck(
-    #     "GET",
-    #     "/projects/columns/%s/cards" % '910796',
-    #     None,
-    #     {"Accept": GITHUB_ACCEPT}
+    # headers, data = request_projects_api(
+    #     "GET", "/projects/columns/%s/cards" % '910796'
     # )
     # pprint(data)
 
-    issues = [issue for issue in repo.get_issues()]  # no laziness !
+    issue_index = get_issue_index(args.repository).refresh()
 
     labels = {}
     for language in languages:
@@ -206,6 +245,9 @@ if __name__ == "__main__":
         print("No videos were found for ids %s." % ', '.join(ids))
         exit(0)
 
+    issue_templates = get_issue_templates()
+    executor = MutationExecutor()
+
     for video in videos:
         print("Handling video %s of duration %s :"
               % (video.yid, str(video.duration)))
@@ -214,40 +256,36 @@ if __name__ == "__main__":
             cprint("  It's a live. Skipping...", "red")
             continue
 
-        for language in languages:
+        # The bodies of all the languages are rendered at once, they share
+        # the parts that depend on the video only.
+        for language, issue_body in issue_templates.render_languages(
+                video, languages):
 
-            issue_title = "[subtitles] [%s] %s" % \
-                          (language['short'], video.title)
+            issue_title = get_issue_title(language['short'], video)
 
             print("  Looking for issue %s..."
                   % colored(issue_title, "yellow"))
 
-            found = False
-            for issue in issues:
-                if issue.title == issue_title:
-                    found = True
-                    break
-            if found:
+            if issue_index.find(language['short'], video) is not None:
                 print("  Found existing issue. Skipping...")
             else:
-                print("  Issue not found. Creating it now...")
-                issue_body = language['issue'].format(video=video)
-                issue = repo.create_issue(
-                    issue_title,
-                    body=issue_body,
-                    labels=[labels[language['short']], label_start]
-                )
-                # Ok, this is a total hack that may break at any point,
-                # because the Cards API is a dev-preview only.
-                print("  Creating a card for it as well...")
-                headers, data = rq.requestJsonAndCheck(
-                    verb="POST",
-                    url="/projects/columns/%s/cards" % language['column'],
-                    input={
-                        'content_id': issue.id,
-                        'content_type': 'Issue'
-                    },
-                    headers={"Accept": GITHUB_ACCEPT}
+                print("  Issue not found. Creating it and its card...")
+                executor.submit(
+                    "Create issue %s" % issue_title,
+                    create_issue, executor, args.repository,
+                    language['short'], video, issue_title, issue_body,
+                    [labels[language['short']].name, label_start.name],
+                    int(language['column'])
                 )
 
+    mutations = executor.wait()
+    for mutation in mutations:
+        print(u"  %s : %s" % (mutation.description, mutation.outcome))
+
+    failures = executor.failures()
+    if failures:
+        cprint("Failed %d out of %d operation%s."
+               % (len(failures), len(mutations), _s(mutations)), "red")
+        exit(1)
+
     cprint("Done!", "green")
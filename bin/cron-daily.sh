@@ -32,7 +32,7 @@ cd ..
 
 
 # Download the subtitles from youtube
-python bin/youtube.py --action download \
+python bin/youtube.py --action download --incremental \
                       --directory ../jlm-video-subtitles/subtitles \
                       |& tee download.log
 
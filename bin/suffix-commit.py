@@ -5,18 +5,16 @@
 # IMPORTS #####################################################################
 
 import os
-import re
 import sys
 import logging
 import argparse
 
-from github import Github
 from oauth2client.tools import argparser as youtube_argparser
 
 THIS_DIRECTORY = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(os.path.abspath(os.path.join(THIS_DIRECTORY, '..')))
 
-from lib.github import GITHUB_API_KEY
+from lib.issues import get_issue_index
 from lib.common import get_downloaded_captions_and_videos, remove_country_code
 
 
@@ -101,26 +99,18 @@ if __name__ == "__main__":
     if 0 == len(captions):
         exit(0)
 
-    gh = Github(GITHUB_API_KEY)
-    repo = gh.get_repo(args.repository)
-    issues = [issue for issue in repo.get_issues()]  # memoize it
+    issue_index = get_issue_index(args.repository).refresh()
+    issue_numbers = issue_index.get_numbers_by_video()
 
     output_lines = []
     for video, caption in zip(videos, captions):
 
-        # We're not relying only on issue title anymore as it may have changed.
-        # We also rely on the video id that we parse from the issue content.
+        # We're not relying on issue title as it may have changed.
+        # We rely on the video id that we parsed from the issue content.
         language = remove_country_code(caption.language)
-        issue_title_prefix = "[subtitles] [%s]" % language
-        r = re.compile(r"https://www\.youtube\.com/watch\?v=([a-zA-Z0-9._-]+)")
-
-        for issue in issues:
-            matches = r.search(issue.body)
-            if matches is not None \
-                    and matches.group(1) == video.yid \
-                    and issue.title.startswith(issue_title_prefix):
-                output_lines.append(" Closes #%d." % issue.number)
-                break
+        issue_number = issue_numbers.get((video.yid, language))
+        if issue_number is not None:
+            output_lines.append(" Closes #%d." % issue_number)
 
     if output_lines:
         print(''.join(output_lines))
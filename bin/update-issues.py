@@ -7,18 +7,19 @@
 # IMPORTS #####################################################################
 
 import os
-import re
 import sys
 import logging
 import argparse
 
-from github import Github, Requester
 from oauth2client.tools import argparser as youtube_argparser
 
 THIS_DIRECTORY = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(os.path.abspath(os.path.join(THIS_DIRECTORY, '..')))
 
-from lib.github import GITHUB_API_KEY
+from lib.github import request_projects_api
+from lib.issues import get_issue_index
+from lib.board import get_board_index
+from lib.mutations import MutationExecutor
 from lib.common import get_downloaded_captions_and_videos, remove_country_code
 
 # CONFIG ######################################################################
@@ -34,17 +35,20 @@ APPROVAL_COLUMNS = {
     'zh': 654920,
 }
 
-# The GitHub Projects API is still in development
-# - https://developer.github.com/v3/projects
-# - It's not supported by the python lib yet
-# - We need to provide a special "Accept" header
-# So, we hack in our own support ; it's dirty but it works.
-# Be warned : it may break at any moment -_-
-GITHUB_ACCEPT = "application/vnd.github.inertia-preview+json"
-rq = Requester.Requester(
-    GITHUB_API_KEY, None, "https://api.github.com", 10, None, None,
-    'PyGithub/Python', 30, False
-)
+
+# FUNCTIONS ###################################################################
+
+def move_card(issue_number, card_id, column_id):
+    # Hack forever...
+    headers, data = request_projects_api(
+        "POST",
+        "/projects/columns/cards/%d/moves" % card_id,
+        input={
+            'position': 'top',
+            'column_id': column_id
+        }
+    )
+    get_board_index().set(issue_number, card_id, column_id)
 
 
 # MAIN ########################################################################
@@ -126,79 +130,64 @@ if __name__ == "__main__":
     if 0 == len(captions):
         sys.exit(0)
 
-    gh = Github(GITHUB_API_KEY)
-    repo = gh.get_repo(args.repository)
-    issues = [issue for issue in repo.get_issues()]  # memoize it
+    issue_index = get_issue_index(args.repository).refresh()
+
+    issues = []  # list of tuples (issue or None, language)
+    for video, caption in zip(videos, captions):
+        language = remove_country_code(caption.language)
+        issues.append((issue_index.find(language, video), language))
 
     # There's no easy way of getting a Card an issue is associated with.
     # But there's a way of getting the Issue number of a specific Card.
-    # We have to get all the Cards from all the Columns, and then find ours.
-    # This is such a hack... But hey, when life gives you lemons ; REROLL!
-    cards = []  # array of dict {id: ?, issue_number: ?}
-    columns = [  # all columns but the last one
-        910796, 398412, 398414, 398416,  # fr
-        387590, 387592, 654829, 387597,  # en
-        654910, 654907, 654913, 654916,  # de
-        654906, 654912, 654915, 654918,  # pt
-        654908, 654914, 654917, 654920,  # zh
-    ]
-    for column_id in columns:
-        headers, data = rq.requestJsonAndCheck(
-            "GET",
-            "/projects/columns/%d/cards" % column_id,
-            None,
-            {"Accept": GITHUB_ACCEPT}
+    # So we keep a board of the cards of all the columns, kept current by the
+    # web bot, and list them all again when it is too old or misses a card.
+    # The issues that still have no card after that are recorded, so that
+    # they do not make the next runs list all the cards again.
+    board = get_board_index()
+    issue_numbers = [issue.number for issue, _ in issues if issue is not None]
+    if board.is_stale() or any(
+            issue_number not in board and not board.is_missing(issue_number)
+            for issue_number in issue_numbers):
+        print("Listing the cards of the project boards...")
+        board.refresh(args.repository)
+        board.set_missing([
+            issue_number for issue_number in issue_numbers
+            if issue_number not in board
+        ])
+
+    executor = MutationExecutor()
+
+    for issue, language in issues:
+
+        if issue is None:
+            continue
+        print("Grab card id for issue %d (#%d)..." % (issue.id, issue.number))
+        card = board.get(issue.number)
+        if card is None:
+            log.warn("Issue #%d has no card we could find." % issue.number)
+            continue
+        card_id, card_column_id = card
+        if language not in APPROVAL_COLUMNS:
+            log.warn("Issue #%d is not in a supported language: %s."
+                     % (issue.number, language))
+            continue
+        column_id = APPROVAL_COLUMNS[language]
+        if card_column_id == column_id:
+            print("Card %d is already in column %d." % (card_id, column_id))
+            continue
+        print("Move card %d to column %d..." % (card_id, column_id))
+        executor.submit(
+            "Move card %d of issue #%d to column %d"
+            % (card_id, issue.number, column_id),
+            move_card, issue.number, card_id, column_id
         )
-        for card_data in data:
-            if 'content_url' not in card_data:
-                # We have cards that are not linked to issues. Ignore them.
-                continue
-            m = re.search("([0-9]+)$", card_data['content_url'])
-            if not m:
-                log.warn("Card #%d has un-parsable content url '%s'."
-                         % (card_data['id'], card_data['content_url']))
-                continue
-            issue_number = int(m.group(1))
-            cards.append({
-                'id': card_data['id'],
-                'issue_number': issue_number,
-            })
-    # END HACK ################################################################
 
-    for video, caption in zip(videos, captions):
+    mutations = executor.wait()
+    for mutation in mutations:
+        print("%s : %s" % (mutation.description, mutation.outcome))
 
-        language = remove_country_code(caption.language)
-        issue_title = "[subtitles] [%s] %s" % (language, video.title)
-
-        for issue in issues:
-            if issue.title == issue_title:
-                print("Grab card id for issue %d (#%d)..."
-                      % (issue.id, issue.number))
-                # Hack continued... :p
-                card_id = None
-                for card in cards:
-                    if card['issue_number'] == issue.number:
-                        card_id = card['id']
-                        break
-                if not card_id:
-                    log.warn("Issue #%d has no card we could find."
-                             % issue_number)
-                    continue
-                if language not in APPROVAL_COLUMNS:
-                    log.warn("Issue #%d is not in a supported language: %s."
-                             % (issue_number, language))
-                    break
-                column_id = APPROVAL_COLUMNS[language]
-                print("Move card %d to column %d..."
-                      % (card_id, column_id))
-                # Hack forever...
-                headers, data = rq.requestJsonAndCheck(
-                    verb="POST",
-                    url="/projects/columns/cards/%d/moves" % card_id,
-                    input={
-                        'position': 'top',
-                        'column_id': column_id
-                    },
-                    headers={"Accept": GITHUB_ACCEPT}
-                )
-                break
+    failures = executor.failures()
+    if failures:
+        log.error("Failed to move %d out of %d cards."
+                  % (len(failures), len(mutations)))
+        sys.exit(1)
@@ -40,6 +40,10 @@ import isodate
 import strict_rfc3339
 import argparse
 import httplib2
+import logging
+import threading
+
+from multiprocessing.pool import ThreadPool
 
 from oauth2client.tools import argparser as youtube_argparser
 
@@ -53,13 +57,22 @@ from github import Github, Requester
 THIS_DIRECTORY = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(os.path.abspath(os.path.join(THIS_DIRECTORY, '..')))
 
-from lib.youtube import get_authenticated_service, get_videos, \
-    parse_videos_from_json, get_videos_of_channel, get_captions_for_video, \
-    get_caption_file_by_id, upload_caption
+from lib.youtube import get_credentials, build_service, get_videos, \
+    parse_videos_from_json, iterate_videos_of_channel, \
+    get_captions_for_video, get_caption_file_by_id, upload_caption, \
+    get_caption_data, Video
+from lib.files import write_file_atomically, iter_chunks, \
+    iter_chunks_with_header, hash_normalized_text
+from lib.index import CaptionIndex
+from lib.journal import Journal, get_journal_path
+from lib.session import configure_sessions, POOL_SIZE
+from lib.quota import get_quota_ledger, configure_quota, QuotaExceeded
 
 # use Colorama to make Termcolor work on all platforms
 init()
 
+logging.basicConfig(format='%(message)s')
+
 THIS_DIRECTORY = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -71,6 +84,187 @@ def _s(int_or_list):
     return '' if int_or_list == 1 else 's'
 
 
+###############################################################################
+
+# The service built by googleapiclient relies on httplib2, which is not
+# thread-safe, so each worker of the download pool gets its own, built from
+# the credentials shared by all of them.
+_worker = threading.local()
+
+
+def get_worker_service(credentials):
+    if not hasattr(_worker, 'youtube'):
+        _worker.youtube = build_service(credentials)
+    return _worker.youtube
+
+
+def print_quota_usage():
+    usage = get_quota_ledger().usage()
+    print("Spent %s out of %s units of YouTube API quota on %s." % (
+        colored(usage['used'], "yellow"), colored(usage['budget'], "yellow"),
+        usage['day']
+    ))
+    for endpoint in sorted(usage['units'].keys()):
+        print("  %s : %d call%s, %d units" % (
+            endpoint, usage['calls'][endpoint],
+            _s(usage['calls'][endpoint]), usage['units'][endpoint]
+        ))
+
+
+def download_caption(youtube, video, caption_data, captions_directory,
+                     caption_extension, index):
+    """
+    Downloads the caption track described by caption_data, and writes it in
+    the year subdirectory of the captions directory, unless the file there
+    already has the same contents, according to the hash of the contents
+    stored in the index, or to the file itself.
+    :return: a tuple (filename of the caption file, whether it was written)
+    """
+    caption_id = caption_data['id']
+    caption_lang = caption_data['snippet']['language']
+    caption_contents = get_caption_data(youtube, caption_id, caption_extension)
+
+    # YouTube writes comments on the first three lines of the VTT file:
+    # WEBVTT
+    # Kind: captions
+    # Language: fr
+    #
+    # So we're going to append our metadata to these comments.
+    # The contents are streamed to the file in chunks, with our metadata
+    # injected on the way, so that we never copy them whole in memory.
+    if caption_extension == 'vtt':
+        caption_header = (
+            u"LastUpdated: %s\n" % caption_data['snippet']['lastUpdated'] +
+            u"Caption: %s\n" % caption_id +
+            u"Video: %s\n" % video.yid
+        ).encode('utf-8')
+
+        def caption_chunks():
+            return iter_chunks_with_header(
+                caption_contents, caption_header, after_lines=3
+            )
+    else:
+        def caption_chunks():
+            return iter_chunks(caption_contents)
+
+    caption_filename = "%s.%s.%s.%s.%s" % (
+        video.date.strftime("%Y-%m-%d"), video.slug,
+        caption_lang, caption_id, caption_extension
+    )
+
+    caption_year = video.date.strftime("%Y")
+    caption_path = os.path.join(
+        captions_directory, caption_year, caption_filename
+    )
+
+    # Unchanged captions never touch the disk, so that their mtime does not
+    # change and git and the other scripts do not even look at them.
+    content_hash = hash_normalized_text(caption_contents)
+    known_caption = index.get(caption_id, scan=False)
+    if known_caption is not None \
+            and known_caption.content_hash == content_hash \
+            and known_caption.filename == caption_filename:
+        index.touch(caption_id, caption_data['snippet']['lastUpdated'])
+        return caption_filename, False
+
+    written = write_file_atomically(caption_path, caption_chunks)
+    index.update(caption_path, content_hash=content_hash)
+
+    return caption_filename, written
+
+
+def download_captions_of_video(credentials, video, captions_directory,
+                               caption_extension, index, incremental=False,
+                               journal=None, done_captions=()):
+    """
+    Lists the caption tracks of the video, then downloads and writes the
+    standard, published ones.
+    Runs inside a worker of the download pool : it does not print anything,
+    but returns the lines to print so that the output stays ordered.
+    A failure is reported in the lines and counted, and does not stop the
+    other downloads. Only running out of quota does.
+    :param index: the CaptionIndex of the captions directory, kept up to date
+        with the files we write.
+    :param incremental: when True, tracks that were not updated since we last
+        downloaded them are not downloaded again.
+    :param journal: the Journal in which to record each caption we are done
+        with, if any.
+    :param done_captions: ids of the captions a previous run was done with.
+    :return: a tuple (lines, counts), counts being a dict of the captions
+        downloaded, ignored, unchanged and failed.
+    """
+    lines = ["Retrieving captions for %s" % colored(video.title, "yellow")]
+    counts = dict(downloaded=0, ignored=0, unchanged=0, failed=0)
+
+    try:
+        youtube = get_worker_service(credentials)
+        jsonResponse = get_captions_for_video(video.yid)
+    except QuotaExceeded:
+        raise
+    except Exception as e:
+        lines.append(colored("  Failed to list captions : %s" % e, "red"))
+        counts['failed'] += 1
+        return lines, counts
+
+    for caption_data in jsonResponse['items']:
+        caption_kind = caption_data['snippet']['trackKind']
+        if caption_kind != 'standard':
+            lines.append("  Ignored caption of kind %s." % caption_kind)
+            counts['ignored'] += 1
+            continue
+        if caption_data['snippet']['isDraft']:
+            lines.append("  Ignored caption draft.")
+            counts['ignored'] += 1
+            continue
+
+        caption_id = caption_data['id']
+
+        if caption_id in done_captions:
+            lines.append("  Already retrieved caption %s." % caption_id)
+            counts['unchanged'] += 1
+            continue
+
+        known_caption = None
+        if incremental:
+            known_caption = index.get(caption_id, scan=False)
+        if known_caption is not None:
+            last_updated = dateutil.parser.parse(
+                caption_data['snippet']['lastUpdated']
+            )
+            if last_updated <= known_caption.modified_at:
+                lines.append("  Unchanged caption %s." % caption_id)
+                counts['unchanged'] += 1
+                if journal is not None:
+                    journal.record('caption', id=caption_id)
+                continue
+
+        try:
+            caption_filename, written = download_caption(
+                youtube, video, caption_data, captions_directory,
+                caption_extension, index
+            )
+        except QuotaExceeded:
+            raise
+        except Exception as e:
+            lines.append(colored(
+                "  Failed to retrieve caption %s : %s" % (caption_id, e), "red"
+            ))
+            counts['failed'] += 1
+            continue
+
+        if written:
+            counts['downloaded'] += 1
+            lines.append("  Retrieved %s" % colored(caption_filename, "blue"))
+        else:
+            counts['unchanged'] += 1
+            lines.append("  Retrieved %s, unchanged"
+                         % colored(caption_filename, "blue"))
+        if journal is not None:
+            journal.record('caption', id=caption_id)
+
+    return lines, counts
+
+
 ###############################################################################
 
 
@@ -112,7 +306,6 @@ if __name__ == "__main__":
         the captions of the specified video⋅s, and not of all the other videos
         of the channel, like it would normally do.
         Very useful to make a quick backup of only one or more video⋅s.
-        You cannot provide more than 50 video ids to this parameter.
         Remember: YouTube's API has quotas, and using this option is the best
         way to not blow them.
         """
@@ -147,6 +340,64 @@ if __name__ == "__main__":
         """ % THIS_DIRECTORY
     )
 
+    argparser.add_argument(
+        "-j", "--jobs", dest="jobs", type=int, default=8,
+        metavar="JOBS",
+        help="""
+        How many videos to handle concurrently when downloading captions.
+        Each job lists the caption tracks of a video, then downloads and
+        writes them. Use 1 to download sequentially. The default is 8.
+        """
+    )
+
+    argparser.add_argument(
+        "--incremental", dest="incremental", action="store_true",
+        help="""
+        Only download the captions that were updated on YouTube since we
+        last downloaded them, according to the LastUpdated metadata we write
+        in the header of the local files. New captions are downloaded too.
+        This only works with the vtt extension.
+        """
+    )
+
+    argparser.add_argument(
+        "--resume", dest="resume", action="store_true",
+        help="""
+        Resume the previous run, if it did not complete : skip the videos and
+        captions it was done with, and continue listing the videos of the
+        channel where it stopped. Every run keeps a journal of its progress
+        for that purpose, in the var/state directory of this project, so that
+        it survives a fresh clone of the captions.
+        """
+    )
+
+    argparser.add_argument(
+        "--only-new", dest="only_new", action="store_true",
+        help="""
+        Stop listing the videos of the channel at the first one that already
+        has captions in the directory. Videos are listed latest first, so
+        only the videos published since the last backup are handled.
+        This option is ignored if you provide the --videos option.
+        """
+    )
+
+    argparser.add_argument(
+        "--quota-budget", dest="quota_budget", type=int, default=None,
+        metavar="UNITS",
+        help="""
+        How many units of YouTube API quota we may spend per day, all scripts
+        included. We stop calling the API when the budget is spent.
+        The default is %d.
+        """ % get_quota_ledger().budget
+    )
+
+    argparser.add_argument(
+        "--quota", dest="quota", action="store_true",
+        help="""
+        Show how much of the YouTube API quota was spent today and exit.
+        """
+    )
+
     argparser.add_argument(
         "--action", dest="action", default="help",
         choices=['help', 'download', 'upload'],
@@ -164,6 +415,13 @@ if __name__ == "__main__":
 
     args = argparser.parse_args()
 
+    if args.quota_budget is not None:
+        configure_quota(budget=args.quota_budget)
+
+    if args.quota:
+        print_quota_usage()
+        argparser.exit(0)
+
     if args.help or args.action == 'help':
         argparser.print_help()
         argparser.exit(0)
@@ -177,9 +435,20 @@ if __name__ == "__main__":
 
     caption_extension = args.extension
 
+    if args.jobs < 1:
+        cprint("The --jobs option must be a positive integer.", "red")
+        exit(1)
+    if args.incremental and caption_extension != 'vtt':
+        cprint("The --incremental option requires the vtt extension.", "red")
+        exit(1)
+    if args.jobs > POOL_SIZE:
+        # Keep one connection alive per job
+        configure_sessions(pool_size=args.jobs)
+
     cprint("Authenticating with YouTube...", "yellow")
 
-    youtube = get_authenticated_service(args)
+    credentials = get_credentials(args)
+    youtube = build_service(credentials)
 
     # ACTION = UPLOAD #########################################################
 
@@ -224,6 +493,13 @@ if __name__ == "__main__":
 
     # ACTION = DOWNLOAD #######################################################
 
+    index = CaptionIndex.open(captions_directory, caption_extension)
+
+    journal = Journal(get_journal_path(captions_directory))
+    journal.open(resume=args.resume)
+    done_videos = journal.ids_of_type('video')
+    done_captions = journal.ids_of_type('caption')
+
     videos = []
     if args.videos:
         print(
@@ -232,18 +508,22 @@ if __name__ == "__main__":
             colored("...", "yellow")
         )
         jsonResponse = get_videos(args.videos)
-        if jsonResponse['pageInfo']['totalResults'] != len(args.videos):
-            if len(args.videos) == 1:
+        requested_count = len(set(args.videos))
+        if jsonResponse['pageInfo']['totalResults'] != requested_count:
+            if requested_count == 1:
                 cprint("""
                 Video %s probably do not exist.
                 """ % args.videos[0], "red")
             else:
+                found_ids = [item['id'] for item in jsonResponse['items']]
                 cprint("""
                 We could only retrieve %d out of the %d videos you provided.
-                Either they don't exist, or you provided too many, because
-                we do not support pagination here yet. Ask for it?
+                These probably do not exist : %s
                 """ % (
-                    jsonResponse['pageInfo']['totalResults'], len(args.videos)
+                    jsonResponse['pageInfo']['totalResults'], requested_count,
+                    ', '.join([
+                        _id for _id in args.videos if _id not in found_ids
+                    ])
                 ), "red")
             exit(1)
         videos.extend(parse_videos_from_json(jsonResponse))
@@ -254,81 +534,101 @@ if __name__ == "__main__":
             colored("...", "yellow")
         )
 
-        jsonResponse = get_videos_of_channel(args.channel)
-        videos.extend(parse_videos_from_json(jsonResponse))
-        while 'nextPageToken' in jsonResponse:
-            jsonResponse = get_videos_of_channel(
-                args.channel, page=jsonResponse['nextPageToken']
-            )
-            videos.extend(parse_videos_from_json(jsonResponse))
+        is_known = None
+        if args.only_new:
+            index.refresh()
+            is_known = index.has_video
+
+        # The pages listed by the run we resume, if any.
+        page = None
+        pages = journal.of_type('page')
+        for record in pages:
+            videos.extend([Video(*video) for video in record['videos']])
+            page = record['next']
+        if pages:
+            print("Resuming with the %d video%s listed by the previous run."
+                  % (len(videos), _s(videos)))
+
+        if not pages or page is not None:
+            for page_videos, next_page in iterate_videos_of_channel(
+                    args.channel, page=page, is_known=is_known):
+                videos.extend(page_videos)
+                journal.record('page', next=next_page, videos=[
+                    [v.yid, v.title, v.published_at] for v in page_videos
+                ])
 
     print("Found %s video%s." % (
         colored(str(len(videos)), "yellow"), _s(videos)
     ))
 
-    cprint("Downloading captions from YouTube...", "yellow")
-
-    captions_count = 0
-
-    for video in videos:
-        print("Retrieving captions for %s" % colored(video.title, "yellow"))
-        jsonResponse = get_captions_for_video(video.yid)
-
-        for caption_data in jsonResponse['items']:
-            caption_kind = caption_data['snippet']['trackKind']
-            if caption_kind != 'standard':
-                print("  Ignored caption of kind %s." % caption_kind)
-                continue
-            if caption_data['snippet']['isDraft']:
-                print("  Ignored caption draft.")
-                continue
+    if args.incremental:
+        cprint("Indexing local captions...", "yellow")
+        index.refresh().save()
+        print("Found %s local caption%s." % (
+            colored(str(len(index)), "yellow"), _s(len(index))
+        ))
 
-            caption_id = caption_data['id']
-            caption_lang = caption_data['snippet']['language']
-            caption_contents = youtube.captions().download(
-                id=caption_id,
-                tfmt=caption_extension
-            ).execute().decode('utf-8')
-
-            # YouTube writes comments on the first three lines of the VTT file:
-            # WEBVTT
-            # Kind: captions
-            # Language: fr
-            #
-            # So we're going to append our metadata to these comments.
-            if caption_extension == 'vtt':
-                caption_lines = caption_contents.split("\n")
-                caption_contents_header = caption_lines[0:3]
-                caption_contents_rest = caption_lines[3:]
-                caption_contents_header.append(
-                    "LastUpdated: %s" % caption_data['snippet']['lastUpdated']
-                )
-                caption_contents_header.append("Caption: %s" % caption_id)
-                caption_contents_header.append("Video: %s" % video.yid)
-                caption_contents = "\n".join(caption_contents_header) + "\n" \
-                                   + "\n".join(caption_contents_rest)
-
-            caption_filename = "%s.%s.%s.%s.%s" % (
-                video.date.strftime("%Y-%m-%d"), video.slug,
-                caption_lang, caption_id, caption_extension
-            )
+    if done_videos:
+        videos = [video for video in videos if video.yid not in done_videos]
+        print("Skipping %s video%s done by the previous run." % (
+            colored(str(len(done_videos)), "yellow"), _s(len(done_videos))
+        ))
 
-            caption_year = video.date.strftime("%Y")
-            caption_path = os.path.join(
-                captions_directory, caption_year, caption_filename
-            )
+    cprint("Downloading captions from YouTube using %d job%s..."
+           % (args.jobs, _s(args.jobs)), "yellow")
 
-            if not os.path.exists(os.path.dirname(caption_path)):
-                os.makedirs(os.path.dirname(caption_path))
-            with open(caption_path, mode="w") as caption_file:
-                caption_file.write(caption_contents.encode('utf-8'))
+    started_at = datetime.datetime.now()
+    totals = dict(downloaded=0, ignored=0, unchanged=0, failed=0)
 
-            captions_count += 1
-            print("  Retrieved %s" % colored(caption_filename, "blue"))
+    def _download(video):
+        return download_captions_of_video(
+            credentials, video, captions_directory, caption_extension, index,
+            args.incremental, journal, done_captions
+        )
 
-    print("Downloaded a grand total of %s caption%s." % (
-        colored(captions_count, "yellow"), _s(captions_count)
-    ))
+    # The pool works ahead, but imap yields the results in the order of the
+    # videos, so the progress output reads just like a sequential run.
+    quota_exceeded = False
+    pool = ThreadPool(args.jobs)
+    try:
+        for i, (lines, counts) in enumerate(pool.imap(_download, videos)):
+            for line in lines:
+                print(line)
+            for key, count in counts.items():
+                totals[key] += count
+            if not counts['failed']:
+                journal.record('video', id=videos[i].yid)
+    except QuotaExceeded as e:
+        cprint("Stopping, we are out of YouTube API quota : %s" % e, "red")
+        quota_exceeded = True
+    finally:
+        pool.terminate()
+        index.save()
+        journal.close()
+
+    elapsed = datetime.datetime.now() - started_at
+
+    print("Downloaded a grand total of %s caption%s, ignored %s, "
+          "skipped %s unchanged, for %s video%s in %s." % (
+              colored(totals['downloaded'], "yellow"),
+              _s(totals['downloaded']),
+              colored(totals['ignored'], "yellow"),
+              colored(totals['unchanged'], "yellow"),
+              colored(len(videos), "yellow"), _s(videos),
+              colored(str(elapsed).split('.')[0], "yellow")
+          ))
+    if totals['failed']:
+        cprint("%d download%s failed." % (
+            totals['failed'], _s(totals['failed'])
+        ), "red")
+    print_quota_usage()
+
+    if quota_exceeded or totals['failed']:
+        cprint("Run again with --resume to only retry what is missing.",
+               "red")
+        exit(1)
+
+    journal.remove()
 
     cprint("Done!", "green")
     exit(0)
@@ -0,0 +1,318 @@
+# coding=utf-8
+import os
+import re
+import json
+import time
+import fcntl
+import socket
+import logging
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from github import GithubException
+from requests.exceptions import ConnectionError as RequestsConnectionError, \
+    Timeout
+
+try:
+    from httplib import HTTPException
+except ImportError:
+    from http.client import HTTPException
+
+from lib.files import make_directory_of
+from lib.github import GITHUB_REPO, LABELS_COLUMNS, GithubGraphQLError, \
+    request_projects_api, iter_issues_with_cards
+
+log = logging.getLogger('Board')
+
+
+###############################################################################
+
+BOARD_FILE = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'var', 'board.json'
+))
+
+# The columns of the project boards, of all the languages.
+BOARD_COLUMNS = [
+    column_id for _, column_ids in LABELS_COLUMNS for column_id in column_ids
+]
+
+# The webhook keeps the board current, but it may miss some events, so we
+# list the cards of all the columns again when the board is older than that.
+BOARD_MAX_AGE = 24 * 3600  # seconds
+
+# How many columns we fetch at once.
+BOARD_JOBS = 8
+
+# The most GitHub allows.
+CARDS_PER_PAGE = 100
+
+CONTENT_URL_ISSUE_REGEX = re.compile(r"/issues/([0-9]+)$")
+NEXT_PAGE_REGEX = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+_board = None
+_board_lock = threading.Lock()
+
+
+def get_issue_number(content_url):
+    """
+    Returns the number of the issue a card is linked to, from its content url,
+    or None if the card is a note.
+    """
+    m = CONTENT_URL_ISSUE_REGEX.search(content_url or '')
+    return int(m.group(1)) if m else None
+
+
+def get_cards_of_column(column_id):
+    """
+    Returns the list of all the cards of a column, as given by the API.
+    """
+    cards = []
+    url = "/projects/columns/%d/cards?per_page=%d" \
+          % (column_id, CARDS_PER_PAGE)
+    while url is not None:
+        headers, data = request_projects_api("GET", url)
+        cards.extend(data)
+        m = NEXT_PAGE_REGEX.search(headers.get('link', ''))
+        url = m.group(1) if m else None
+    return cards
+
+
+###############################################################################
+
+class BoardIndex:
+    """
+    Maps the issues to the card they have in our project boards, and to the
+    column the card is in, as there's no way to ask GitHub for the card of an
+    issue.
+
+    It is stored in a file shared by our scripts and the web bot, that keeps
+    it current from the project_card events it receives. The changes are
+    made while holding a lock on the file, so that no process loses the
+    changes of another, and the changes made by the events received while
+    we list the cards are kept over the listing.
+    """
+
+    def __init__(self, path=BOARD_FILE, columns=None):
+        self.path = path
+        self.columns = columns or BOARD_COLUMNS
+        self.cards = {}  # issue number => (card id, column id)
+        self.changed_at = {}  # issue number => when an event changed it
+        self.missing = set()  # issue numbers without a card at the refresh
+        self.synced_at = 0
+        self.lock = threading.RLock()
+
+    # PERSISTENCE #############################################################
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as board_file:
+                data = json.load(board_file)
+        except (IOError, ValueError):
+            return self
+        with self.lock:
+            self.cards = dict(
+                (int(number), tuple(card))
+                for number, card in data['cards'].items()
+            )
+            self.changed_at = dict(
+                (int(number), changed_at)
+                for number, changed_at in data.get('changed_at', {}).items()
+            )
+            self.missing = set(data.get('missing', []))
+            self.synced_at = data['synced_at']
+        return self
+
+    def save(self):
+        make_directory_of(self.path)
+        with self.lock:
+            data = {
+                'synced_at': self.synced_at,
+                'cards': self.cards,
+                'changed_at': self.changed_at,
+                'missing': sorted(self.missing),
+            }
+            temporary_path = "%s.tmp.%d" % (self.path, os.getpid())
+            with open(temporary_path, 'w') as board_file:
+                json.dump(data, board_file, separators=(',', ':'))
+            os.rename(temporary_path, self.path)
+        return self
+
+    # SYNC ####################################################################
+
+    def is_stale(self, max_age=BOARD_MAX_AGE):
+        return time.time() - self.synced_at > max_age
+
+    def refresh(self, repository=GITHUB_REPO, jobs=BOARD_JOBS):
+        """
+        Finds the cards of the open issues of the repository with a few
+        GraphQL queries, or, if that fails, lists the cards of all the
+        columns, a few columns at once. Then saves the board.
+        """
+        synced_at = time.time()
+        try:
+            cards = self._get_cards_of_issues(repository)
+        except (GithubException, GithubGraphQLError, KeyError, TypeError,
+                RequestsConnectionError, Timeout, socket.error,
+                HTTPException) as e:
+            log.warn("Listing the cards of each column, as we could not "
+                     "query them with GraphQL : %s" % e)
+            cards = self._get_cards_of_columns(jobs)
+
+        def replace_cards():
+            # The events received while we were listing are more recent.
+            for issue_number, changed_at in self.changed_at.items():
+                if changed_at < synced_at:
+                    continue
+                if issue_number in self.cards:
+                    cards[issue_number] = self.cards[issue_number]
+                else:
+                    cards.pop(issue_number, None)
+            self.cards = cards
+            self.changed_at = dict(
+                (issue_number, changed_at)
+                for issue_number, changed_at in self.changed_at.items()
+                if changed_at >= synced_at
+            )
+            self.missing = set()
+            self.synced_at = synced_at
+            return True
+
+        self._update(replace_cards)
+        return self
+
+    def apply_event(self, payload):
+        """
+        Updates the board from the payload of a project_card event.
+        https://developer.github.com/v3/activity/events/types/#projectcardevent
+        :return: True if the board changed
+        """
+        card_data = payload['project_card']
+        issue_number = get_issue_number(card_data.get('content_url'))
+        if issue_number is None:
+            return False
+
+        def apply():
+            if payload['action'] == 'deleted':
+                if self.cards.get(issue_number, (None,))[0] \
+                        != card_data['id']:
+                    return False
+                del self.cards[issue_number]
+            else:
+                self.cards[issue_number] = (
+                    card_data['id'], card_data['column_id']
+                )
+                self.missing.discard(issue_number)
+            self.changed_at[issue_number] = time.time()
+            return True
+
+        return self._update(apply)
+
+    # LOOKUPS #################################################################
+
+    def get(self, issue_number):
+        """
+        Returns a tuple (card id, column id) of the card of the issue, or None.
+        """
+        with self.lock:
+            return self.cards.get(issue_number)
+
+    def set(self, issue_number, card_id, column_id):
+        """
+        Records the card of an issue, eg. one we just created or moved,
+        and saves the board.
+        """
+        def set_card():
+            self.cards[issue_number] = (card_id, column_id)
+            self.changed_at[issue_number] = time.time()
+            self.missing.discard(issue_number)
+            return True
+
+        self._update(set_card)
+
+    def set_missing(self, issue_numbers):
+        """
+        Records the issues that have no card on the board, right after a
+        refresh, so that we do not list all the cards again because of them
+        until the board is stale, eg. for blacklisted issues.
+        """
+        def set_missing():
+            self.missing = set(
+                issue_number for issue_number in issue_numbers
+                if issue_number not in self.cards
+            )
+            return True
+
+        self._update(set_missing)
+
+    def is_missing(self, issue_number):
+        """
+        Whether the issue had no card at the last refresh, see set_missing().
+        """
+        with self.lock:
+            return issue_number in self.missing
+
+    def __contains__(self, issue_number):
+        return issue_number in self.cards
+
+    def __len__(self):
+        return len(self.cards)
+
+    # INTERNALS ###############################################################
+
+    def _update(self, callback):
+        """
+        Loads the board, lets the callback change it, and saves it if the
+        callback returns True, while holding a lock on the file so that our
+        scripts and the processes of the web bot do not lose any change.
+        :return: what the callback returns
+        """
+        make_directory_of(self.path)
+        with self.lock:
+            with open("%s.lock" % self.path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self.load()  # other processes may have changed it
+                    changed = callback()
+                    if changed:
+                        self.save()
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return changed
+
+    def _get_cards_of_issues(self, repository):
+        columns = set(self.columns)
+        cards = {}
+        for issue in iter_issues_with_cards(repository):
+            for card_id, column_id in issue['cards']:
+                if column_id in columns:
+                    cards[issue['number']] = (card_id, column_id)
+        return cards
+
+    def _get_cards_of_columns(self, jobs):
+        pool = ThreadPool(min(jobs, len(self.columns)))
+        try:
+            columns_cards = pool.map(get_cards_of_column, self.columns)
+        finally:
+            pool.close()
+            pool.join()
+        cards = {}
+        for column_id, column_cards in zip(self.columns, columns_cards):
+            for card_data in column_cards:
+                issue_number = get_issue_number(card_data.get('content_url'))
+                if issue_number is None:
+                    # We have cards that are not linked to issues.
+                    continue
+                cards[issue_number] = (card_data['id'], column_id)
+        return cards
+
+
+def get_board_index():
+    """
+    Returns the board index shared by the whole process, as loaded from disk.
+    """
+    global _board
+    with _board_lock:
+        if _board is None:
+            _board = BoardIndex().load()
+        return _board
@@ -0,0 +1,170 @@
+# coding=utf-8
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+###############################################################################
+
+CACHE_DIRECTORY = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'var', 'cache'
+))
+
+# Entries older than this are dropped instead of being revalidated.
+CACHE_TTL = 7 * 24 * 3600  # seconds
+
+# When the entries weigh more than this, the least recently used are evicted.
+CACHE_MAX_SIZE = 32 * 1024 * 1024  # bytes
+
+# How many entries to store between two evictions, as they have to stat all.
+EVICT_EVERY = 64
+
+# Query parameters that do not change the response, like API keys.
+IGNORED_PARAMETERS = ['key', 'access_token']
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+###############################################################################
+
+class ResponseCache:
+    """
+    An on-disk cache of the bodies of the responses, along with their ETag,
+    keyed by URL and query parameters.
+    Send the ETag of the entry in a If-None-Match header, and if the server
+    answers 304 Not Modified, use the stored body.
+
+    There is one file per entry, whose mtime is bumped when it is used, so
+    that the least recently used entries can be evicted when the cache grows
+    larger than max_size.
+    """
+
+    def __init__(self, directory, ttl=CACHE_TTL, max_size=CACHE_MAX_SIZE):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.puts = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def get(self, url, parameters=None):
+        """
+        Returns the entry for the request, a dict with 'etag' and 'body',
+        or None if there is none, or if it expired.
+        """
+        path = self._path(url, parameters)
+        try:
+            with open(path, 'r') as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, IOError, ValueError):
+            return None
+        if time.time() - entry.get('stored_at', 0) > self.ttl:
+            self._unlink(path)
+            return None
+        try:
+            os.utime(path, None)  # least recently used is now the others
+        except OSError:
+            pass
+        return entry
+
+    def put(self, url, parameters, etag, body):
+        """
+        Stores the body of the response to the request, and its ETag.
+        """
+        self._write(self._path(url, parameters), {
+            'url': url,
+            'etag': etag,
+            'body': body,
+            'stored_at': time.time(),
+        })
+        with self.lock:
+            self.puts += 1
+            evict = self.puts % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def revalidate(self, url, parameters, entry):
+        """
+        Records that the server told us the entry of the request was not
+        modified, so that it lives for another ttl.
+        """
+        entry = dict(entry)
+        entry['stored_at'] = time.time()
+        self._write(self._path(url, parameters), entry)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache weighs less
+        than max_size, and the entries unused for longer than the ttl.
+        """
+        with self.lock:
+            now = time.time()
+            entries = []
+            size = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if now - stat.st_mtime > self.ttl:
+                    self._unlink(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                size += stat.st_size
+            if size <= self.max_size:
+                return
+            for mtime, entry_size, path in sorted(entries):
+                self._unlink(path)
+                size -= entry_size
+                if size <= self.max_size:
+                    break
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                self._unlink(os.path.join(self.directory, name))
+
+    def _path(self, url, parameters=None):
+        key = url
+        if parameters:
+            key += '?' + '&'.join([
+                u"%s=%s" % (k, v) for k, v in sorted(parameters.items())
+                if k not in IGNORED_PARAMETERS
+            ])
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, "%s.json" % key)
+
+    def _write(self, path, entry):
+        temporary_path = "%s.%d.tmp" % (
+            path, threading.current_thread().ident
+        )
+        with open(temporary_path, 'w') as entry_file:
+            json.dump(entry, entry_file, separators=(',', ':'))
+        os.rename(temporary_path, path)
+
+    def _unlink(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def get_response_cache(name):
+    """
+    Returns the shared response cache of that name, eg. 'youtube'.
+    """
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = ResponseCache(os.path.join(CACHE_DIRECTORY, name))
+        return _caches[name]
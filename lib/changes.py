@@ -0,0 +1,266 @@
+# coding=utf-8
+import os
+import re
+import json
+import time
+import struct
+import hashlib
+import logging
+
+from binascii import hexlify
+from subprocess import check_output
+
+from lib.files import get_state_path, make_directory_of
+
+log = logging.getLogger('Changes')
+
+
+###############################################################################
+
+# The cache of the hashes of the changed files is stored in our var/
+# directory, like the index. It is shared by all the scripts run in a row.
+CHANGES_FILE_SUFFIX = '.changes.json'
+
+# We only look for changed captions. We do not honor the ignore rules of git
+# like `git add -n .` does, so limiting the scan to the extensions of the
+# captions keeps out the files git would never commit, eg. editor backups.
+CAPTION_EXTENSIONS = ('vtt', 'srt', 'sbv')
+
+# The index entries are made of ten 32 bits stat fields, the sha1 of the
+# object and 16 bits of flags, followed by the path.
+INDEX_ENTRY = struct.Struct(">10I20sH")
+
+INDEX_EXTENDED_FLAG = 0x4000
+INDEX_STAGE_MASK = 0x3000
+
+
+class UnsupportedGitIndex(Exception):
+    pass
+
+
+def get_changes_path(captions_directory):
+    return get_state_path(captions_directory, CHANGES_FILE_SUFFIX)
+
+
+# GIT #########################################################################
+
+def find_git_directory(path):
+    """
+    Returns a tuple (work tree, git directory) of the repository path is in,
+    or (None, None) if it is not in a repository.
+    """
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, '.git')
+        if os.path.isdir(dot_git):
+            return path, dot_git
+        if os.path.isfile(dot_git):  # worktrees and submodules
+            with open(dot_git, 'r') as dot_git_file:
+                m = re.match(r"gitdir: (.+)", dot_git_file.read().strip())
+            if m:
+                return path, os.path.join(path, m.group(1))
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None, None
+        path = parent
+
+
+def read_git_index(git_directory):
+    """
+    Reads the index (aka. staging area) of the repository.
+    Supports the versions 2, 3 and 4 of the format, but not split indexes.
+    https://github.com/git/git/blob/master/Documentation/technical/index-format.txt
+    :return: a dict of path relative to the work tree => tuple
+        (mtime seconds, size, sha1 hex digest)
+    """
+    with open(os.path.join(git_directory, 'index'), 'rb') as index_file:
+        data = index_file.read()
+
+    signature, version, count = struct.unpack(">4sII", data[:12])
+    if signature != b"DIRC" or version not in (2, 3, 4):
+        raise UnsupportedGitIndex("Index version %d" % version)
+
+    entries = {}
+    offset = 12
+    previous_path = b""
+    for _ in range(count):
+        fields = INDEX_ENTRY.unpack_from(data, offset)
+        mtime, size, sha, flags = fields[2], fields[9], fields[10], fields[11]
+        cursor = offset + INDEX_ENTRY.size
+        if flags & INDEX_EXTENDED_FLAG:
+            cursor += 2
+        if version == 4:
+            # The path is prefix-compressed : it removes some bytes from the
+            # end of the previous path, and appends the ones that follow.
+            byte = ord(data[cursor:cursor + 1])
+            cursor += 1
+            strip = byte & 0x7f
+            while byte & 0x80:
+                byte = ord(data[cursor:cursor + 1])
+                cursor += 1
+                strip = ((strip + 1) << 7) | (byte & 0x7f)
+            end = data.index(b"\0", cursor)
+            path = previous_path[:len(previous_path) - strip] \
+                + data[cursor:end]
+            offset = end + 1
+        else:
+            end = data.index(b"\0", cursor)
+            path = data[cursor:end]
+            # Entries are padded with 1 to 8 NULs to a multiple of 8 bytes.
+            offset += ((end - offset) // 8 + 1) * 8
+        previous_path = path
+        if flags & INDEX_STAGE_MASK:
+            continue  # merge conflicts
+        entries[path.decode('utf-8')] = (
+            mtime, size, hexlify(sha).decode('ascii')
+        )
+
+    if data[offset:offset + 4] == b"link":
+        raise UnsupportedGitIndex("Split index")
+
+    return entries
+
+
+def hash_git_blob(path):
+    """
+    Returns the sha1 git would give to the contents of the file at path.
+    """
+    with open(path, 'rb') as blob_file:
+        contents = blob_file.read()
+    sha = hashlib.sha1(b"blob " + str(len(contents)).encode('ascii') + b"\0")
+    sha.update(contents)
+    return sha.hexdigest()
+
+
+# CHANGES #####################################################################
+
+class ChangeDetector:
+    """
+    Finds the files of a directory that were added or modified since they
+    were last staged in git, like `git add -n .` would for the captions,
+    but without spawning git nor refreshing its index.
+
+    Files whose stat did not change since they were staged are not read.
+    The others are hashed, and their hashes are cached, by stat, in a file
+    in our var/ directory so that the scripts that run one after the other
+    (update-issues, suffix-commit) only hash each changed file once.
+    """
+
+    def __init__(self, directory, cache_path=None,
+                 extensions=CAPTION_EXTENSIONS):
+        self.directory = os.path.abspath(directory)
+        self.suffixes = tuple('.' + extension for extension in extensions)
+        self.cache_path = cache_path or get_changes_path(self.directory)
+        self.cache = {}  # relative path => [mtime, size, sha]
+        self.hashed = {}  # the entries of the cache used by this scan
+
+    def iter_changed_paths(self):
+        """
+        Returns an iterator on the absolute paths of the added or modified
+        caption files. Hidden files, files in hidden directories, and files
+        with other extensions are ignored.
+        :raises UnsupportedGitIndex: when we cannot read the index of git.
+        """
+        work_tree, git_directory = find_git_directory(self.directory)
+        if git_directory is None:
+            raise UnsupportedGitIndex("Not in a git repository")
+        entries = read_git_index(git_directory)
+        index_mtime = int(
+            os.stat(os.path.join(git_directory, 'index')).st_mtime
+        )
+        self._load()
+        return self._iter_changed_paths(work_tree, entries, index_mtime)
+
+    def _iter_changed_paths(self, work_tree, entries, index_mtime):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            dirnames[:] = sorted(
+                [d for d in dirnames if not d.startswith('.')]
+            )
+            for name in sorted(filenames):
+                if name.startswith('.') or not name.endswith(self.suffixes):
+                    continue
+                path = os.path.join(dirpath, name)
+                tree_path = os.path.relpath(path, work_tree)
+                tree_path = tree_path.replace(os.sep, '/')
+                entry = entries.get(tree_path)
+                if entry is None:
+                    yield path  # added
+                    continue
+                stat = os.stat(path)
+                mtime, size = int(stat.st_mtime), stat.st_size
+                # When the file was modified in the same second it was
+                # staged, the stat can't tell, so we need to hash it.
+                if mtime == entry[0] and size == entry[1] \
+                        and mtime < index_mtime:
+                    continue
+                if self._hash(path, tree_path, mtime, size) != entry[2]:
+                    yield path  # modified
+
+        self._save()
+
+    def _hash(self, path, key, mtime, size):
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] == mtime and cached[1] == size:
+            self.hashed[key] = cached
+            return cached[2]
+        sha = hash_git_blob(path)
+        # A file modified during this very second may be modified again
+        # without its stat changing, so we can't cache its hash yet.
+        if mtime < int(time.time()):
+            self.hashed[key] = [mtime, size, sha]
+        return sha
+
+    def _load(self):
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                self.cache = json.load(cache_file)
+        except (IOError, ValueError):
+            self.cache = {}
+
+    def _save(self):
+        """
+        Writes the entries used by this scan, so that the cache only holds
+        the hashes of the files that are currently changed.
+        """
+        if self.hashed == self.cache:
+            return
+        make_directory_of(self.cache_path)
+        temporary_path = "%s.tmp" % self.cache_path
+        with open(temporary_path, 'w') as cache_file:
+            json.dump(self.hashed, cache_file, separators=(',', ':'))
+        os.rename(temporary_path, self.cache_path)
+        self.cache = self.hashed
+
+
+def iter_changed_paths(directory, extensions=CAPTION_EXTENSIONS):
+    """
+    Returns an iterator on the absolute paths of the caption files of the
+    directory that were added or modified since they were last staged in git.
+    Falls back to asking git itself when we cannot read its index.
+    """
+    try:
+        return ChangeDetector(
+            directory, extensions=extensions
+        ).iter_changed_paths()
+    except (UnsupportedGitIndex, IOError, ValueError, struct.error) as e:
+        log.warn("Asking git for the changes, as we can't : %s" % e)
+        suffixes = tuple('.' + extension for extension in extensions)
+        return iter([
+            path for path in _get_changed_paths_from_git(directory)
+            if path.endswith(suffixes)
+        ])
+
+
+def _get_changed_paths_from_git(directory):
+    files_raw = check_output(["git add -n ."], shell=True, cwd=directory)
+    if not isinstance(files_raw, str):
+        files_raw = files_raw.decode('utf-8')
+    root = check_output(
+        ["git rev-parse --show-toplevel"], shell=True, cwd=directory
+    ).strip()
+    if not isinstance(root, str):
+        root = root.decode('utf-8')
+    return [
+        os.path.join(root, path)
+        for path in re.findall("^add '(.+)'$", files_raw, flags=re.MULTILINE)
+    ]
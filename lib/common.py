@@ -3,12 +3,12 @@ import re
 import sys
 import logging
 
-from subprocess import check_output
-
 THIS_DIRECTORY = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(os.path.abspath(os.path.join(THIS_DIRECTORY, '..')))
 
-from lib.youtube import Caption, get_videos, parse_videos_from_json
+from lib.youtube import get_videos, parse_videos_from_json
+from lib.index import CaptionIndex
+from lib.changes import iter_changed_paths
 
 logging.basicConfig(format='%(message)s')
 log = logging.getLogger('Common')
@@ -16,14 +16,12 @@ log = logging.getLogger('Common')
 
 def get_downloaded_captions_and_videos(captions_directory):
 
-    files_raw = check_output(
-        ["git add -n ."], shell=True, cwd=captions_directory
-    )
-    git_added_paths = re.findall("^add '(.+)'$", files_raw, flags=re.MULTILINE)
+    git_added_paths = list(iter_changed_paths(captions_directory))
 
     if 0 == len(git_added_paths):
         return [], []
 
+    index = CaptionIndex.open(captions_directory)
     captions = []
     for git_caption_path in git_added_paths:
         # path may be arbitrarily prefixed but it'll always end by
@@ -36,12 +34,30 @@ def get_downloaded_captions_and_videos(captions_directory):
         caption_path = os.path.join(
             captions_directory, caption_year, caption_filename
         )
-        captions.append(Caption.from_file(caption_path))
+        caption = index.get_by_path(caption_path)
+        if caption is None:
+            log.error("No caption metadata in '%s'." % caption_path)
+            sys.exit(1)
+        captions.append(caption)
+    index.save()
 
     videos = get_videos([caption.video_id for caption in captions])
-    videos = parse_videos_from_json(videos)
+    videos = dict(
+        (video.yid, video) for video in parse_videos_from_json(videos)
+    )
+
+    # Both lists are zipped by the callers, so we keep them aligned.
+    found_captions = []
+    found_videos = []
+    for caption in captions:
+        if caption.video_id not in videos:
+            log.warn("No video found for caption '%s' of video '%s'."
+                     % (caption.id, caption.video_id))
+            continue
+        found_captions.append(caption)
+        found_videos.append(videos[caption.video_id])
 
-    return captions, videos
+    return found_captions, found_videos
 
 
 def remove_country_code(language):
@@ -0,0 +1,67 @@
+# coding=utf-8
+
+
+###############################################################################
+
+# The names of the days, starting on monday like date.weekday(), and of the
+# months, per language, so that we never have to switch the locale of the
+# whole process to format a date : it is neither thread-safe nor fast.
+DAY_NAMES = {
+    'fr': (u"lundi", u"mardi", u"mercredi", u"jeudi", u"vendredi",
+           u"samedi", u"dimanche"),
+    'en': (u"Monday", u"Tuesday", u"Wednesday", u"Thursday", u"Friday",
+           u"Saturday", u"Sunday"),
+    'de': (u"Montag", u"Dienstag", u"Mittwoch", u"Donnerstag", u"Freitag",
+           u"Samstag", u"Sonntag"),
+}
+
+MONTH_NAMES = {
+    'fr': (u"janvier", u"février", u"mars", u"avril", u"mai", u"juin",
+           u"juillet", u"août", u"septembre", u"octobre", u"novembre",
+           u"décembre"),
+    'en': (u"January", u"February", u"March", u"April", u"May", u"June",
+           u"July", u"August", u"September", u"October", u"November",
+           u"December"),
+    'de': (u"Januar", u"Februar", u"März", u"April", u"Mai", u"Juni",
+           u"Juli", u"August", u"September", u"Oktober", u"November",
+           u"Dezember"),
+}
+
+# What strftime gave with the locale of each language, and our formats :
+# fr_FR "%A %d %B %Y", capitalized : "Samedi 04 mars 2017"
+# en_US "%A, %d %B %Y"             : "Saturday, 04 March 2017"
+# de_DE "%A %d %B %Y"              : "Samstag 04 März 2017"
+DAY_FORMATS = {
+    'fr': u"{day} {date.day:02d} {month} {date.year}",
+    'en': u"{day}, {date.day:02d} {month} {date.year}",
+    'de': u"{day} {date.day:02d} {month} {date.year}",
+}
+
+# (language, date) => formatted day
+# Concurrent writes of the same key are harmless, they write the same value.
+_days = {}
+
+
+###############################################################################
+
+def format_day(date, language):
+    """
+    Returns the day of the date, written out in the language,
+    eg. u"Samedi 04 mars 2017".
+    :param date: a date or datetime ; the time is ignored
+    :param language: one of the keys of DAY_FORMATS
+    """
+    if hasattr(date, 'date'):
+        date = date.date()
+    key = (language, date)
+    day = _days.get(key)
+    if day is None:
+        day = DAY_FORMATS[language].format(
+            day=DAY_NAMES[language][date.weekday()],
+            month=MONTH_NAMES[language][date.month - 1],
+            date=date
+        )
+        if language == 'fr':
+            day = day.capitalize()
+        _days[key] = day
+    return day
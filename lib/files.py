@@ -0,0 +1,156 @@
+# coding=utf-8
+import os
+import hashlib
+import tempfile
+
+
+###############################################################################
+
+# Where we keep what we know about the captions directories, like their
+# index. Not next to them, as the daily cron clones the captions afresh.
+STATE_DIRECTORY = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'var', 'state'
+))
+
+# Bytes written or hashed at once.
+CHUNK_SIZE = 64 * 1024
+
+# The temporary files are created with restrictive permissions, so we give
+# them the permissions a regular file would have before renaming them.
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+
+###############################################################################
+
+def get_state_path(directory, suffix):
+    """
+    Returns the path of a file in STATE_DIRECTORY where we keep something
+    about the directory, eg. get_state_path(captions, '.index.json').
+    Its name is derived from the absolute path of the directory, so that
+    each directory has its own, whatever the current directory.
+    """
+    directory = os.path.abspath(directory)
+    key = directory
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    digest = hashlib.sha1(key).hexdigest()[:12]
+    name = os.path.basename(directory) or 'root'
+    return os.path.join(STATE_DIRECTORY, "%s-%s%s" % (name, digest, suffix))
+
+
+def make_directory_of(path):
+    """
+    Creates the directory of the file at path, if needed.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Already there, maybe created by another thread meanwhile.
+            if not os.path.isdir(directory):
+                raise
+
+
+def iter_chunks(data, chunk_size=CHUNK_SIZE):
+    """
+    Yields the bytes of data in slices of chunk_size, without copying them.
+    """
+    view = memoryview(data)
+    for start in range(0, len(data), chunk_size):
+        yield view[start:start + chunk_size]
+
+
+def iter_chunks_with_header(data, header, after_lines=0,
+                            chunk_size=CHUNK_SIZE):
+    """
+    Yields the bytes of data in chunks, with the bytes of header inserted
+    after the after_lines first lines of data.
+    """
+    position = 0
+    for _ in range(after_lines):
+        newline = data.find(b"\n", position)
+        if newline == -1:
+            position = len(data)
+            break
+        position = newline + 1
+
+    view = memoryview(data)
+    yield view[:position]
+    if position and data[position - 1:position] != b"\n":
+        yield b"\n"
+    yield header
+    for chunk in iter_chunks(view[position:], chunk_size):
+        yield chunk
+
+
+def hash_chunks(chunks):
+    sha = hashlib.sha1()
+    for chunk in chunks:
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_normalized_text(data):
+    """
+    Returns the sha1 hex digest of the bytes of a text, with its line endings
+    and trailing whitespace normalized, so that it only changes when the
+    text really does.
+    """
+    return hashlib.sha1(data.replace(b"\r\n", b"\n").rstrip()).hexdigest()
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    """
+    Returns the sha1 hex digest of the contents of the file at path, or None
+    if there is no such file.
+    """
+    sha = hashlib.sha1()
+    try:
+        with open(path, 'rb') as open_file:
+            chunk = open_file.read(chunk_size)
+            while chunk:
+                sha.update(chunk)
+                chunk = open_file.read(chunk_size)
+    except IOError:
+        return None
+    return sha.hexdigest()
+
+
+def write_file_atomically(path, chunks_factory):
+    """
+    Writes the chunks of bytes to a temporary file next to path, and then
+    renames it to path, so that the file at path is never torn, even if the
+    process dies while writing.
+    Nothing is written if the file at path already has the same contents.
+    :param chunks_factory: a callable returning an iterable of the chunks,
+        called twice : once to hash them, once to write them.
+    :return: True if the file was written, False if it was unchanged.
+    """
+    if hash_chunks(chunks_factory()) == hash_file(path):
+        return False
+
+    make_directory_of(path)
+    directory = os.path.dirname(path)
+
+    temporary = tempfile.NamedTemporaryFile(
+        dir=directory, prefix='.', suffix='.tmp', delete=False
+    )
+    try:
+        with temporary:
+            for chunk in chunks_factory():
+                temporary.write(chunk)
+            temporary.flush()
+            os.fsync(temporary.fileno())
+        os.chmod(temporary.name, FILE_MODE)
+        os.rename(temporary.name, path)
+    except BaseException:
+        try:
+            os.remove(temporary.name)
+        except OSError:
+            pass
+        raise
+
+    return True
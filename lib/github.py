@@ -1,8 +1,27 @@
 # coding=utf-8
 import os
+import re
+import json
+import time
+import socket
+import threading
 
 from colorama import init
 from termcolor import colored, cprint
+from github import Github, GithubException
+from requests.exceptions import ConnectionError as RequestsConnectionError, \
+    Timeout
+
+try:
+    from httplib import HTTPException
+    from urlparse import urlparse
+except ImportError:
+    from http.client import HTTPException
+    from urllib.parse import urlparse
+
+from lib.retry import call_with_retries, is_retriable_status
+from lib.session import get_session
+from lib.languages import load_languages
 
 
 ###############################################################################
@@ -38,6 +57,49 @@ except IOError:
 
 GITHUB_REPO = "jlm2017/jlm-video-subtitles"
 
+GITHUB_API_URL = "https://api.github.com"
+
+# The Projects API is still in development
+# - https://developer.github.com/v3/projects
+# - It's not supported by the python lib yet
+# - We need to provide a special "Accept" header
+# So, we hack in our own support ; it's dirty but it works.
+# Be warned : it may break at any moment -_-
+GITHUB_PROJECTS_ACCEPT = "application/vnd.github.inertia-preview+json"
+
+# Seconds to wait when we trigger the abuse detection of GitHub.
+GITHUB_ABUSE_DELAY = 60
+
+# Seconds between two requests changing things, as GitHub asks.
+# https://developer.github.com/v3/guides/best-practices-for-integrators/
+GITHUB_MUTATION_INTERVAL = 1.0
+
+# When we have less requests than that left, we spread them until the reset.
+GITHUB_RATE_LIMIT_RESERVE = 100
+
+# The issues with their labels and project cards, a page at a time.
+# https://developer.github.com/v4/
+GITHUB_ISSUES_QUERY = """
+query ($owner: String!, $name: String!, $states: [IssueState!],
+       $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    issues(first: 100, after: $cursor, states: $states) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number databaseId title body state updatedAt
+        labels(first: 100) { nodes { name } }
+        projectCards(first: 10) {
+          nodes { databaseId column { databaseId } }
+        }
+      }
+    }
+  }
+}
+"""
+
+# Upper bounds of the buckets of the histograms of the latencies, in seconds.
+GITHUB_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
 LABELS_COLUMNS = [              # [fr, en, de, pt, zh]
     (u"⚙ [0] Awaiting subtitles", [910796, 387590, 654910, 654905, 654911]),
     (u"⚙ [1] Writing in progress", [398412, 387592, 654907, 654906, 654908]),
@@ -46,90 +108,367 @@ LABELS_COLUMNS = [              # [fr, en, de, pt, zh]
     (u"⚙ [4] Approved", [398417, 390130, 654919, 654918, 654920]),
 ]
 
-LANGUAGES = [
-    {
-        'short': 'fr',
-        'label': u'⚑ Français',
-        'column': '910796',
-        'issue': u"""
-## {video.title}
-
-&nbsp;          | Info
---------------- | ---------------
-**Date**        | {video.day_fr}
-**Durée**       | {video.duration} :clock7:
-**Langue**      | Français :fr:
-**Vidéo**       | [Voir dans YouTube :arrow_upper_right:](https://www.youtube.com/watch?v={video.yid})
-**Sous-titres** | [Éditer dans YouTube :arrow_upper_right:](https://www.youtube.com/timedtext_editor?v={video.yid}&tab=captions&bl=vmp&action_mde_edit_form=1&lang=fr&ui=hd)
-"""
-    }
-    ,
-    {
-        'short': 'en',
-        'label': u'⚑ English',
-        'column': '387590',
-        'issue': u"""
-## {video.title}
-
-&nbsp;        | Info
-------------- | -------------
-**Date**      | {video.day_en}
-**Duration**  | {video.duration} :clock7:
-**Language**  | English :gb:
-**Video**     | [See it on YouTube :arrow_upper_right:](https://www.youtube.com/watch?v={video.yid})
-**Subtitles** | [Edit them in YouTube :arrow_upper_right:](https://www.youtube.com/timedtext_editor?v={video.yid}&tab=captions&bl=vmp&action_mde_edit_form=1&lang=en&ui=hd)
-"""
-    }
-    ,
-    {
-        'short': 'de',
-        'label': u'⚑ Deutsche',
-        'column': '654910',
-        'issue': u"""
-## {video.title}
-
-&nbsp;         | Info
--------------- | -------------
-**Datum**      | {video.day_en}
-**Dauer**      | {video.duration} :clock7:
-**Sprache**    | Deutsche :de:
-**Video**      | [See it on YouTube :arrow_upper_right:](https://www.youtube.com/watch?v={video.yid})
-**Untertitel** | [Edit them in YouTube :arrow_upper_right:](https://www.youtube.com/timedtext_editor?v={video.yid}&tab=captions&bl=vmp&action_mde_edit_form=1&lang=de&ui=hd)
-"""
-    }
-    ,
-    {
-        'short': 'pt',
-        'label': u'⚑ Português',
-        'column': '654905',
-        'issue': u"""
-## {video.title}
-
-&nbsp;         | Info
--------------- | -------------
-**Datum**      | {video.day_en}
-**Dauer**      | {video.duration} :clock7:
-**Sprache**    | Português :pt:
-**Video**      | [See it on YouTube :arrow_upper_right:](https://www.youtube.com/watch?v={video.yid})
-**Untertitel** | [Edit them in YouTube :arrow_upper_right:](https://www.youtube.com/timedtext_editor?v={video.yid}&tab=captions&bl=vmp&action_mde_edit_form=1&lang=pt&ui=hd)
-"""
-    }
-    ,
-    {
-        'short': 'zh',
-        'label': u'⚑ Chinese',  # 中国, but github labels sorting sucks
-        'column': '654911',
-        'issue': u"""
-## {video.title}
-
-&nbsp;        | Info
-------------- | -------------
-**Date**      | {video.day_en}
-**Duration**  | {video.duration} :clock7:
-**Language**  | 中国 :cn:
-**Video**     | [See it on YouTube :arrow_upper_right:](https://www.youtube.com/watch?v={video.yid})
-**Subtitles** | [Edit them in YouTube :arrow_upper_right:](https://www.youtube.com/timedtext_editor?v={video.yid}&tab=captions&bl=vmp&action_mde_edit_form=1&lang=zh&ui=hd)
-"""
-    }
-]
+# The languages we write subtitles in, see config/languages.yml
+LANGUAGES = load_languages()
+
+
+###############################################################################
+
+_client = None
+_client_lock = threading.Lock()
+_github = None
+
+
+class GithubGraphQLError(Exception):
+    pass
+
+
+class GithubClient:
+    """
+    The client of the GitHub API shared by the whole process :
+    - it keeps its connections alive in a pool, see lib.session ;
+    - it tracks the requests we have left from the headers of the responses,
+      and paces the requests to not run out of them before their reset,
+      nor trigger the abuse detection with bursts of mutations ;
+    - it counts, per endpoint, the calls, errors and bytes received, and
+      keeps a histogram of the latencies.
+    """
+
+    def __init__(self, token=GITHUB_API_KEY, url=GITHUB_API_URL):
+        self.url = url
+        self.session = get_session('github')
+        self.headers = {
+            'Authorization': "token %s" % token,
+            'Accept': "application/vnd.github.v3+json",
+        }
+        self.lock = threading.Lock()
+        self.limit = None       # requests per hour
+        self.remaining = None   # requests left until the reset
+        self.reset_at = None    # timestamp
+        self.paused_until = 0   # timestamp, when GitHub told us to wait
+        self.next_call_at = 0
+        self.next_mutation_at = 0
+        self.endpoints = {}     # endpoint => dict of counters
+
+    def request(self, verb, url, parameters=None, headers=None, input=None):
+        """
+        Sends one request, without retrying.
+        :return: a tuple (status, headers, data), headers in lowercase
+        :raises GithubException: when the status is 400 or more, with the
+            headers of the response in its `headers` attribute.
+        """
+        if not url.startswith('http'):
+            url = self.url + url
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+        if input is not None:
+            request_headers['Content-Type'] = "application/json"
+
+        # Our GraphQL requests are queries, not mutations. They have their
+        # own rate limit, in points, which is not the one of the REST API
+        # we track and pace the requests against.
+        is_graphql = url.endswith('/graphql')
+        self._wait_for_turn(
+            verb not in ('GET', 'HEAD') and not is_graphql, not is_graphql
+        )
+        started_at = time.time()
+        response = self.session.request(
+            verb, url, params=parameters, headers=request_headers,
+            data=json.dumps(input) if input is not None else None
+        )
+        content = response.content
+        self._count(verb, url, response.status_code, len(content),
+                    time.time() - started_at)
+
+        response_headers = dict(
+            (k.lower(), v) for k, v in response.headers.items()
+        )
+        if not is_graphql:
+            self._track(response_headers)
+        if response.status_code >= 400:
+            # Server errors may come with an HTML page, or nothing.
+            try:
+                data = json.loads(content.decode('utf-8'))
+            except ValueError:
+                data = None
+            error = GithubException(response.status_code, data)
+            error.headers = response_headers
+            raise error
+        data = json.loads(content.decode('utf-8')) if content else None
+        return response.status_code, response_headers, data
+
+    def pause(self, delay):
+        """
+        Makes all the requests wait delay seconds from now.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + delay)
+
+    def stats(self):
+        """
+        Returns the rate limit of the REST API and the counters of each
+        endpoint.
+        """
+        with self.lock:
+            return {
+                'limit': self.limit,
+                'remaining': self.remaining,
+                'reset_at': self.reset_at,
+                'endpoints': json.loads(json.dumps(self.endpoints)),
+            }
+
+    # INTERNALS ###############################################################
+
+    def _wait_for_turn(self, is_mutation, is_counted=True):
+        with self.lock:
+            now = time.time()
+            call_at = max(now, self.paused_until)
+            if is_counted:
+                call_at = max(call_at, self.next_call_at)
+            if is_counted and self.remaining is not None \
+                    and self.reset_at is not None:
+                if self.remaining <= 0:
+                    call_at = max(call_at, self.reset_at + 1)
+                elif self.remaining < GITHUB_RATE_LIMIT_RESERVE:
+                    # Spread the requests we have left until the reset.
+                    self.next_call_at = call_at + max(
+                        0, self.reset_at - now
+                    ) / self.remaining
+                self.remaining -= 1
+            if is_mutation:
+                call_at = max(call_at, self.next_mutation_at)
+                self.next_mutation_at = call_at + GITHUB_MUTATION_INTERVAL
+        if call_at > now:
+            time.sleep(call_at - now)
+
+    def _track(self, headers):
+        try:
+            limit = int(headers['x-ratelimit-limit'])
+            remaining = int(headers['x-ratelimit-remaining'])
+            reset_at = int(headers['x-ratelimit-reset'])
+        except (KeyError, ValueError):
+            return
+        with self.lock:
+            self.limit = limit
+            self.remaining = remaining
+            self.reset_at = reset_at
+
+    def _count(self, verb, url, status, size, latency):
+        endpoint = get_endpoint(verb, url)
+        with self.lock:
+            counters = self.endpoints.get(endpoint)
+            if counters is None:
+                counters = self.endpoints[endpoint] = {
+                    'calls': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0,
+                    'latencies': [0] * (len(GITHUB_LATENCY_BUCKETS) + 1),
+                }
+            counters['calls'] += 1
+            if status >= 400:
+                counters['errors'] += 1
+            counters['bytes'] += size
+            counters['seconds'] += latency
+            bucket = 0
+            while bucket < len(GITHUB_LATENCY_BUCKETS) \
+                    and latency > GITHUB_LATENCY_BUCKETS[bucket]:
+                bucket += 1
+            counters['latencies'][bucket] += 1
+
+
+def get_endpoint(verb, url):
+    """
+    Returns the endpoint of a request, to count them, with the numbers and
+    label names replaced by placeholders,
+    eg. "POST /projects/columns/:id/cards"
+    """
+    path = urlparse(url).path
+    path = re.sub(r"/labels/[^/]+$", "/labels/:name", path)
+    path = re.sub(r"/[0-9]+(?=/|$)", "/:id", path)
+    return "%s %s" % (verb, path)
+
+
+def get_github_client():
+    """
+    Returns the GitHub client shared by the whole process.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GithubClient()
+        return _client
+
+
+def get_github():
+    """
+    Returns the PyGithub instance shared by the whole process, for the few
+    things we still do with PyGithub.
+    """
+    global _github
+    with _client_lock:
+        if _github is None:
+            _github = Github(GITHUB_API_KEY, timeout=30)
+        return _github
+
+
+def get_rate_limit_delay(headers):
+    """
+    Returns the seconds GitHub told us to wait in the headers of a response,
+    with Retry-After, or with X-RateLimit-Reset when we have no requests
+    left, or None.
+    It is at least one second : a delay of zero would tell call_with_retries
+    not to retry at all.
+    """
+    if not headers:
+        return None
+    headers = dict((k.lower(), v) for k, v in headers.items())
+    try:
+        if 'retry-after' in headers:
+            return max(1, int(headers['retry-after']))
+        if headers.get('x-ratelimit-remaining') == '0' \
+                and 'x-ratelimit-reset' in headers:
+            return max(0, int(headers['x-ratelimit-reset']) - time.time()) + 1
+    except ValueError:
+        pass
+    return None
+
+
+def is_retriable_github_error(error):
+    """
+    Whether an exception raised while calling the GitHub API is transient :
+    server errors, rate limits, and network errors.
+    When GitHub told us how long to wait, all the threads wait that long.
+    :return: False, True, or the seconds to wait before retrying
+    """
+    if isinstance(error, GithubException):
+        delay = get_rate_limit_delay(getattr(error, 'headers', None))
+        if delay is not None and error.status in (403, 429):
+            get_github_client().pause(delay)
+            return delay
+        if is_retriable_status(error.status):
+            return True
+        if error.status == 403:
+            message = ("%s" % error.data).lower()
+            if 'abuse' in message or 'secondary rate' in message:
+                get_github_client().pause(GITHUB_ABUSE_DELAY)
+                return GITHUB_ABUSE_DELAY
+            if 'rate limit' in message:
+                return True
+        return False
+    return isinstance(error, (RequestsConnectionError, Timeout, socket.error,
+                              HTTPException))
+
+
+def request_projects_api(verb, url, input=None):
+    """
+    Calls the Projects API, retrying on transient failures.
+    :param verb: "GET", "POST", ...
+    :param url: eg. "/projects/columns/42/cards"
+    :param input: dict to send as JSON, if any
+    :return: a tuple (headers, data)
+    """
+    status, headers, data = request_api(
+        verb, url, None, {"Accept": GITHUB_PROJECTS_ACCEPT}, input
+    )
+    return headers, data
+
+
+def request_api(verb, url, parameters=None, headers=None, input=None):
+    """
+    Calls the GitHub API, retrying on transient failures.
+    Unlike PyGithub, a 304 Not Modified is not an error : send a ETag in a
+    If-None-Match header, and check the status.
+    :param url: eg. "/repos/owner/repo/issues", or a full URL given by the
+        API, like the links to the next pages.
+    :return: a tuple (status, headers, data), headers in lowercase
+    :raises GithubException: when the status is 400 or more, with the
+        headers of the response in its `headers` attribute.
+    """
+    return call_with_retries(
+        lambda: get_github_client().request(
+            verb, url, parameters, headers, input
+        ),
+        is_retriable_github_error,
+        description="%s %s" % (verb, url)
+    )
+
+
+def request_creation(url, input, find, headers=None):
+    """
+    POSTs input to url to create something, like an issue or a card.
+    Creations are not idempotent : when a request fails after GitHub got it,
+    eg. on a timeout or a 502, the thing may exist anyway, and posting again
+    would create it twice. So we never retry the POST blindly : before
+    posting again, find() looks for the thing, and we return it if found.
+    :param find: returns the data of the thing, as the POST would, or None
+    :return: the data of the response, or what find() found
+    """
+    posted = []
+
+    def create():
+        if posted:
+            data = find()
+            if data is not None:
+                return data
+        posted.append(True)
+        status, response_headers, data = get_github_client().request(
+            "POST", url, None, headers, input
+        )
+        return data
+
+    return call_with_retries(
+        create, is_retriable_github_error, description="POST %s" % url
+    )
+
+
+def request_graphql(query, variables=None):
+    """
+    Sends a GraphQL query to the GitHub API, retrying on transient failures.
+    :return: the data of the response
+    :raises GithubGraphQLError: when GitHub reports errors in the query.
+    """
+    status, headers, data = request_api(
+        "POST", "/graphql", input={'query': query, 'variables': variables}
+    )
+    if data.get('errors') or not data.get('data'):
+        raise GithubGraphQLError("; ".join(
+            error.get('message', '?') for error in data.get('errors') or []
+        ) or "No data")
+    return data['data']
+
 
+def iter_issues_with_cards(repository, states=('OPEN',)):
+    """
+    Yields the issues of the repository with their labels and project cards,
+    fetched with GraphQL, a hundred at a time.
+    The issues are dicts shaped like the ones of the REST API, with a 'cards'
+    list of tuples (card id, column id) in addition.
+    :param states: 'OPEN', 'CLOSED', or both
+    """
+    owner, name = repository.split('/')
+    cursor = None
+    while True:
+        data = request_graphql(GITHUB_ISSUES_QUERY, {
+            'owner': owner, 'name': name,
+            'states': list(states), 'cursor': cursor,
+        })
+        issues = data['repository']['issues']
+        for node in issues['nodes']:
+            yield {
+                'number': node['number'],
+                'id': node['databaseId'],
+                'title': node['title'],
+                'body': node['body'],
+                'state': node['state'].lower(),
+                'updated_at': node['updatedAt'],
+                'labels': [
+                    {'name': label['name']}
+                    for label in node['labels']['nodes']
+                ],
+                'cards': [
+                    (card['databaseId'], card['column']['databaseId'])
+                    for card in node['projectCards']['nodes']
+                    if card['column'] is not None
+                ],
+            }
+        if not issues['pageInfo']['hasNextPage']:
+            break
+        cursor = issues['pageInfo']['endCursor']
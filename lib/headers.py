@@ -0,0 +1,115 @@
+# coding=utf-8
+import os
+import re
+
+
+###############################################################################
+
+# Our metadata is written right after the three lines of comments YouTube puts
+# on top of the VTT files, so the whole header fits well in that many bytes.
+HEADER_READ_SIZE = 4096
+
+# The header ends at the first blank line.
+HEADER_END = re.compile(br"\r?\n[ \t]*\r?\n")
+
+# eg. "LastUpdated: 2017-03-04T10:33:04.136Z"
+HEADER_FIELD = re.compile(br"^(\w+): +(.+?)\s*$", re.MULTILINE)
+
+UTF8_BOM = b"\xef\xbb\xbf"
+
+# Field of the header => attribute of the CaptionHeader
+HEADER_FIELDS = {
+    b'Caption': 'id',
+    b'Video': 'video_id',
+    # ISO-639-1 (2 lowercase letters language code),
+    # sometimes followed by a dash - and a
+    # ISO-3166 (2 uppercase letters country code)
+    b'Language': 'language',  # <ISO-639-1>[-<ISO-3166>]
+    b'LastUpdated': 'last_updated',  # RFC 3339
+}
+
+
+class MalformedCaptionFile(Exception):
+    pass
+
+
+# MODEL #######################################################################
+
+class CaptionHeader(object):
+    """
+    The metadata we wrote in the header of a caption file.
+    """
+
+    __slots__ = ('filepath', 'id', 'video_id', 'language', 'last_updated')
+
+    def __init__(self, filepath, id, video_id, language, last_updated):
+        self.filepath = filepath
+        self.id = id
+        self.video_id = video_id
+        self.language = language
+        self.last_updated = last_updated
+
+    def __repr__(self):
+        return "<CaptionHeader %s of video %s in %s>" % (
+            self.id, self.video_id, self.language
+        )
+
+
+###############################################################################
+
+def read_caption_header(filepath, size=HEADER_READ_SIZE):
+    """
+    Parses the metadata in the header of the caption file at filepath,
+    reading only its first size bytes, at once.
+    :raises MalformedCaptionFile: when the header is missing a field, or does
+        not end within the first size bytes.
+    :raises OSError: when the file cannot be read.
+    """
+    descriptor = os.open(filepath, os.O_RDONLY)
+    try:
+        data = os.read(descriptor, size)
+    finally:
+        os.close(descriptor)
+
+    return parse_caption_header(data, filepath, complete=len(data) < size)
+
+
+def parse_caption_header(data, filepath=None, complete=True):
+    """
+    Parses the metadata in the header of the bytes of a caption file.
+    :param complete: whether data holds the whole file, and not only its
+        beginning, in which case the header may end with the file.
+    """
+    if data.startswith(UTF8_BOM):
+        data = data[len(UTF8_BOM):]
+
+    end = HEADER_END.search(data)
+    if end is not None:
+        data = data[:end.start()]
+    elif not complete:
+        raise MalformedCaptionFile(
+            "No end of header in the first bytes of '%s'." % filepath
+        )
+
+    fields = {}
+    for name, value in HEADER_FIELD.findall(data):
+        attribute = HEADER_FIELDS.get(name)
+        if attribute is None:
+            continue
+        try:
+            fields[attribute] = value.decode('utf-8')
+        except UnicodeDecodeError:
+            raise MalformedCaptionFile(
+                "Invalid %s in the header of '%s'." % (attribute, filepath)
+            )
+
+    if len(fields) != len(HEADER_FIELDS):
+        missing = sorted(
+            name.decode('ascii') for name, attribute in HEADER_FIELDS.items()
+            if attribute not in fields
+        )
+        raise MalformedCaptionFile(
+            "Missing %s in the header of '%s'." % (", ".join(missing), filepath)
+        )
+
+    return CaptionHeader(filepath=filepath, **fields)
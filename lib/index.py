@@ -0,0 +1,292 @@
+# coding=utf-8
+import os
+import json
+import logging
+import threading
+
+from lib.youtube import Caption
+from lib.headers import read_caption_header, MalformedCaptionFile
+from lib.files import get_state_path, make_directory_of, hash_file
+
+log = logging.getLogger('Index')
+
+
+###############################################################################
+
+# The index is stored in our var/ directory, and not inside the captions
+# directory, so that it is never committed along with the captions, and it
+# outlives the fresh clones of the captions made by the daily cron.
+INDEX_FILE_SUFFIX = '.index.json'
+
+INDEX_VERSION = 1
+
+
+def get_index_path(captions_directory):
+    return get_state_path(captions_directory, INDEX_FILE_SUFFIX)
+
+
+# MODEL #######################################################################
+
+class CaptionIndex:
+    """
+    A persistent index of the caption files of a directory, mapping the caption
+    id to the file path, video id, language and LastUpdated metadata of the
+    caption, along with the mtime and size of the file when it was indexed,
+    and the hash of the contents we downloaded, when we know it.
+
+    The LastUpdated of a caption whose contents did not change is only
+    recorded here, as we do not write its file again. The hash of the file
+    tells us whether these survive a re-indexing : when the file has
+    another mtime but the same contents, eg. in a fresh clone, they are kept.
+
+    Lookups are dict hits, plus one stat of the file to make sure the entry is
+    still fresh. The files that changed are parsed again, the others are not.
+    """
+
+    def __init__(self, directory, extension='vtt', path=None):
+        self.directory = os.path.abspath(directory)
+        self.extension = extension
+        self.path = path or get_index_path(self.directory)
+        self.entries = {}   # caption id => dict
+        self.by_path = {}   # relative path => caption id
+        self.by_video = {}  # video id => set of caption ids
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def open(directory, extension='vtt', path=None):
+        """
+        Loads the index of the directory from disk, if there is one.
+        It is NOT refreshed, call refresh() to scan the directory for changes.
+        """
+        index = CaptionIndex(directory, extension, path)
+        index.load()
+        return index
+
+    # PERSISTENCE #############################################################
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as index_file:
+                data = json.load(index_file)
+        except (IOError, ValueError):
+            return self
+        if data.get('version') != INDEX_VERSION \
+                or data.get('extension') != self.extension:
+            log.warn("Ignoring outdated caption index '%s'." % self.path)
+            self.dirty = True
+            return self
+        with self.lock:
+            for caption_id, entry in data['captions'].items():
+                self._add(caption_id, entry)
+        return self
+
+    def save(self):
+        """
+        Writes the index to disk, if it changed since it was loaded.
+        The write is atomic, so a crash never leaves a torn index behind.
+        """
+        with self.lock:
+            if not self.dirty:
+                return self
+            data = {
+                'version': INDEX_VERSION,
+                'extension': self.extension,
+                'captions': self.entries,
+            }
+            make_directory_of(self.path)
+            temporary_path = "%s.tmp" % self.path
+            with open(temporary_path, 'w') as index_file:
+                json.dump(data, index_file, separators=(',', ':'))
+            os.rename(temporary_path, self.path)
+            self.dirty = False
+        return self
+
+    # LOOKUPS #################################################################
+
+    def get(self, caption_id, scan=True):
+        """
+        Returns the Caption of id caption_id, or None if there is no file
+        for it in the directory.
+        The directory is only scanned when the id is not in the index, and
+        scan is True.
+        """
+        with self.lock:
+            caption = self._get_fresh(caption_id)
+            if caption is None and scan:
+                self.refresh()
+                caption = self._get_fresh(caption_id)
+            return caption
+
+    def get_by_path(self, filepath):
+        """
+        Returns the Caption stored in the file at filepath, indexing it if
+        needed, or None if the file has no caption metadata.
+        """
+        with self.lock:
+            relative_path = self._relative(filepath)
+            if relative_path in self.by_path:
+                caption = self._get_fresh(self.by_path[relative_path])
+                if caption is not None:
+                    return caption
+            return self.update(filepath)
+
+    def find(self, video_id, language=None):
+        """
+        Returns the list of the indexed Captions of the video, optionally
+        restricted to a language. Entries are not checked against the disk.
+        """
+        with self.lock:
+            captions = [
+                self._to_caption(caption_id, self.entries[caption_id])
+                for caption_id in self.by_video.get(video_id, ())
+            ]
+        if language is not None:
+            captions = [c for c in captions if c.language == language]
+        return captions
+
+    def __contains__(self, caption_id):
+        return caption_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def has_video(self, video_id):
+        return video_id in self.by_video
+
+    # UPDATES #################################################################
+
+    def update(self, filepath, content_hash=None):
+        """
+        (Re-)indexes the caption file at filepath, and returns its Caption.
+        Returns None if the file has no caption metadata.
+        :param content_hash: hash of the contents we downloaded and wrote in
+            the file, see lib.files.hash_normalized_text.
+        """
+        relative_path = self._relative(filepath)
+        absolute_path = os.path.join(self.directory, relative_path)
+        try:
+            stat = os.stat(absolute_path)
+            caption = read_caption_header(absolute_path)
+        except (OSError, IOError, MalformedCaptionFile) as e:
+            if isinstance(e, MalformedCaptionFile):
+                log.warn("Skipping malformed caption file : %s" % e)
+            with self.lock:
+                if relative_path in self.by_path:
+                    self._remove(self.by_path[relative_path])
+                    self.dirty = True
+            return None
+        entry = {
+            'path': relative_path,
+            'video': caption.video_id,
+            'language': caption.language,
+            'updated': caption.last_updated,
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+        }
+        with self.lock:
+            previous = self.entries.get(caption.id)
+            if content_hash is not None:
+                entry['hash'] = content_hash
+                entry['file'] = hash_file(absolute_path)
+            elif previous is not None and 'file' in previous \
+                    and previous['file'] == hash_file(absolute_path):
+                # The file we wrote, with another stat.
+                for key in ('hash', 'file', 'touched'):
+                    if key in previous:
+                        entry[key] = previous[key]
+            if relative_path in self.by_path:
+                self._remove(self.by_path[relative_path])
+            self._remove(caption.id)
+            self._add(caption.id, entry)
+            self.dirty = True
+        return self._to_caption(caption.id, entry)
+
+    def touch(self, caption_id, last_updated):
+        """
+        Records that the caption was updated on YouTube at last_updated
+        (RFC 3339), but that its contents did not change, so that we did not
+        write its file again.
+        """
+        with self.lock:
+            entry = self.entries.get(caption_id)
+            if entry is not None \
+                    and entry.get('touched', entry['updated']) != last_updated:
+                entry['touched'] = last_updated
+                self.dirty = True
+
+    def refresh(self):
+        """
+        Scans the directory and re-indexes the caption files that were added
+        or modified since they were indexed, and forgets about removed files.
+        Unchanged files are only stat-ed, not read.
+        """
+        with self.lock:
+            seen = set()
+            for dirpath, dirnames, filenames in os.walk(self.directory):
+                for name in filenames:
+                    if not name.endswith(self.extension):
+                        continue
+                    filepath = os.path.join(dirpath, name)
+                    relative_path = self._relative(filepath)
+                    seen.add(relative_path)
+                    caption_id = self.by_path.get(relative_path)
+                    if caption_id is not None \
+                            and self._is_fresh(self.entries[caption_id]):
+                        continue
+                    self.update(filepath)
+            for relative_path in list(self.by_path.keys()):
+                if relative_path not in seen:
+                    self._remove(self.by_path[relative_path])
+                    self.dirty = True
+        return self
+
+    # INTERNALS ###############################################################
+
+    def _relative(self, filepath):
+        return os.path.relpath(
+            os.path.join(self.directory, filepath), self.directory
+        )
+
+    def _is_fresh(self, entry):
+        try:
+            stat = os.stat(os.path.join(self.directory, entry['path']))
+        except OSError:
+            return False
+        return stat.st_mtime == entry['mtime'] \
+            and stat.st_size == entry['size']
+
+    def _get_fresh(self, caption_id):
+        entry = self.entries.get(caption_id)
+        if entry is None:
+            return None
+        if not self._is_fresh(entry):
+            return self.update(entry['path'])
+        return self._to_caption(caption_id, entry)
+
+    def _to_caption(self, caption_id, entry):
+        return Caption(
+            filepath=os.path.join(self.directory, entry['path']),
+            filename=os.path.basename(entry['path']),
+            id=caption_id,
+            video_id=entry['video'],
+            language=entry['language'],
+            last_updated=entry.get('touched', entry['updated']),
+            content_hash=entry.get('hash')
+        )
+
+    def _add(self, caption_id, entry):
+        self.entries[caption_id] = entry
+        self.by_path[entry['path']] = caption_id
+        self.by_video.setdefault(entry['video'], set()).add(caption_id)
+
+    def _remove(self, caption_id):
+        entry = self.entries.pop(caption_id, None)
+        if entry is None:
+            return
+        self.by_path.pop(entry['path'], None)
+        video_captions = self.by_video.get(entry['video'])
+        if video_captions is not None:
+            video_captions.discard(caption_id)
+            if not video_captions:
+                del self.by_video[entry['video']]
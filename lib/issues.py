@@ -0,0 +1,372 @@
+# coding=utf-8
+import os
+import re
+import json
+import sqlite3
+import threading
+
+from lib.github import request_api
+
+
+###############################################################################
+
+# eg. "[subtitles] [fr] Le titre de la vidéo"
+ISSUE_TITLE = u"[subtitles] [%s] %s"
+ISSUE_TITLE_REGEX = re.compile(r"^\[subtitles\] \[([a-zA-Z_-]+)\] (.*)$")
+
+# The link to the video, in the body of the issue.
+YOUTUBE_URL_REGEX = re.compile(
+    r"https://www\.youtube\.com/watch\?v=([a-zA-Z0-9._-]+)"
+)
+
+
+def get_issue_title(language, video):
+    return ISSUE_TITLE % (language, video.title)
+
+
+def parse_issue(title, body):
+    """
+    Returns a tuple (language, title of the video, video id) of an issue,
+    with None for the parts we could not find in its title and body.
+    """
+    language = video_title = video_id = None
+    m = ISSUE_TITLE_REGEX.match(title or u"")
+    if m:
+        language, video_title = m.group(1, 2)
+    m = YOUTUBE_URL_REGEX.search(body or u"")
+    if m:
+        video_id = m.group(1)
+    return language, video_title, video_id
+
+
+###############################################################################
+
+
+ISSUES_DATABASE_FILE = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'var', 'issues.sqlite'
+))
+
+# The most GitHub allows.
+ISSUES_PER_PAGE = 100
+
+ISSUES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS issues (
+    repository TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    id INTEGER,
+    title TEXT,
+    language TEXT,
+    video_title TEXT,
+    video_id TEXT,
+    labels TEXT,
+    state TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (repository, number)
+);
+CREATE INDEX IF NOT EXISTS issues_by_video
+    ON issues (repository, language, video_id);
+CREATE INDEX IF NOT EXISTS issues_by_title
+    ON issues (repository, language, video_title);
+CREATE TABLE IF NOT EXISTS syncs (
+    repository TEXT PRIMARY KEY,
+    since TEXT,
+    etag TEXT
+);
+"""
+
+ISSUE_COLUMNS = "number, id, title, language, video_title, video_id, " \
+                "labels, state, updated_at"
+
+NEXT_PAGE_REGEX = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+# MODEL #######################################################################
+
+class Issue(object):
+    """
+    What we keep of an issue : no body, but the id of the video it links to.
+    """
+
+    __slots__ = (
+        'number', 'id', 'title', 'language', 'video_title', 'video_id',
+        'labels', 'state', 'updated_at',
+    )
+
+    def __init__(self, number, id, title, language, video_title, video_id,
+                 labels, state, updated_at):
+        self.number = number
+        self.id = id
+        self.title = title
+        self.language = language
+        self.video_title = video_title
+        self.video_id = video_id
+        self.labels = labels  # list of label names
+        self.state = state  # 'open' or 'closed'
+        self.updated_at = updated_at  # RFC 3339
+
+    def __repr__(self):
+        return "<Issue #%d %s>" % (self.number, self.title)
+
+
+class IssueIndex:
+    """
+    A local copy of the issues of a repository, in a SQLite database shared
+    by all our scripts and the web bot, indexed by (language, video id), from
+    the link to the video in their body, and by (language, video title), from
+    their title, as the body of some issues has no link.
+
+    The first refresh lists all the issues. The next ones only ask for the
+    issues updated since the latest one we know of, with the ETag of that
+    request when we made the very same one before, so that when nothing
+    changed a refresh is one conditional request answered by a 304.
+    """
+
+    def __init__(self, repository, path=ISSUES_DATABASE_FILE):
+        self.repository = repository
+        self.path = path
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        self.connection = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False
+        )
+        self.connection.executescript(ISSUES_SCHEMA)
+        self.lock = threading.RLock()
+        self.refresh_lock = threading.Lock()
+
+    # SYNC ####################################################################
+
+    def refresh(self):
+        """
+        Fetches the issues that were created or updated since the last
+        refresh, by any of our scripts.
+        The lookups are not blocked while we wait for GitHub, only while we
+        store each page. When another thread is already refreshing the index,
+        we wait for it to be done instead of refreshing it again.
+        """
+        if not self.refresh_lock.acquire(False):
+            with self.refresh_lock:
+                return self
+        try:
+            self._refresh()
+        finally:
+            self.refresh_lock.release()
+        return self
+
+    def is_synced(self):
+        """
+        Whether the index was ever refreshed, ie. whether it knows of all the
+        issues that were not updated since, and refreshing it is cheap.
+        """
+        with self.lock:
+            return self._get_sync()[0] is not None
+
+    # LOOKUPS #################################################################
+
+    def find(self, language, video, state='open'):
+        """
+        Returns the Issue of the video in the language, or None.
+        Issues linking to the video are preferred to the ones with its title.
+        :param state: 'open', 'closed', or None for both
+        """
+        query = "SELECT %s FROM issues WHERE repository = ? " \
+                "AND language = ? AND (video_id = ? OR video_title = ?)" \
+                % ISSUE_COLUMNS
+        parameters = [self.repository, language, video.yid, video.title]
+        if state is not None:
+            query += " AND state = ?"
+            parameters.append(state)
+        query += " ORDER BY video_id = ? DESC, number DESC LIMIT 1"
+        parameters.append(video.yid)
+        with self.lock:
+            row = self.connection.execute(query, parameters).fetchone()
+        return self._to_issue(row) if row else None
+
+    def get(self, number):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT %s FROM issues WHERE repository = ? AND number = ?"
+                % ISSUE_COLUMNS, (self.repository, number)
+            ).fetchone()
+        return self._to_issue(row) if row else None
+
+    def issues(self, state='open'):
+        """
+        Returns the list of the Issues, optionally only those in state.
+        """
+        query = "SELECT %s FROM issues WHERE repository = ?" % ISSUE_COLUMNS
+        parameters = [self.repository]
+        if state is not None:
+            query += " AND state = ?"
+            parameters.append(state)
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        return [self._to_issue(row) for row in rows]
+
+    def get_numbers_by_video(self, state='open'):
+        """
+        Returns a dict of (video id, language) => number of the issue, for
+        the issues linking to a video, optionally only those in state.
+        When a video has many issues in a language, the latest one wins.
+        """
+        query = "SELECT video_id, language, number FROM issues " \
+                "WHERE repository = ? AND video_id IS NOT NULL " \
+                "AND language IS NOT NULL"
+        parameters = [self.repository]
+        if state is not None:
+            query += " AND state = ?"
+            parameters.append(state)
+        query += " ORDER BY number"
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        return dict(((video_id, language), number)
+                    for video_id, language, number in rows)
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM issues WHERE repository = ?",
+                (self.repository,)
+            ).fetchone()[0]
+
+    # UPDATES #################################################################
+
+    def add(self, issue):
+        """
+        Stores a PyGithub Issue, eg. one we just created.
+        """
+        with self.lock:
+            with self.connection:
+                self._store(
+                    issue.number, issue.id, issue.title, issue.body,
+                    [label.name for label in issue.labels], issue.state,
+                    issue.updated_at.strftime("%Y-%m-%dT%H:%M:%SZ")
+                )
+
+    def add_data(self, data):
+        """
+        Stores an issue as given by the API, eg. one we just created.
+        """
+        with self.lock:
+            with self.connection:
+                self._store_data(data)
+
+    def set_labels(self, number, labels):
+        """
+        Records the labels of an issue, eg. after we changed them.
+        """
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE issues SET labels = ? "
+                    "WHERE repository = ? AND number = ?",
+                    (json.dumps(labels), self.repository, number)
+                )
+
+    # INTERNALS ###############################################################
+
+    def _refresh(self):
+        with self.lock:
+            since, etag = self._get_sync()
+        parameters = {
+            'state': 'all',
+            'sort': 'updated',
+            'direction': 'asc',
+            'per_page': ISSUES_PER_PAGE,
+        }
+        if since is not None:
+            parameters['since'] = since
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+
+        status, response_headers, data = request_api(
+            "GET", "/repos/%s/issues" % self.repository, parameters, headers
+        )
+        if status == 304:
+            return
+        first_etag = response_headers.get('etag')
+
+        # Each page is stored in its own transaction, so that the other
+        # processes are not locked out of the database while we wait for
+        # the next page. The sync is recorded last : if we stop midway,
+        # the next refresh fetches the same pages again.
+        latest = since
+        while True:
+            with self.lock:
+                with self.connection:
+                    for item in data:
+                        if latest is None or item['updated_at'] > latest:
+                            latest = item['updated_at']
+                        if 'pull_request' in item:
+                            continue
+                        self._store_data(item)
+            next_url = self._get_next_page_url(response_headers)
+            if next_url is None:
+                break
+            status, response_headers, data = request_api("GET", next_url)
+        with self.lock:
+            with self.connection:
+                # `since` is inclusive, so asking again for the issues since
+                # the latest one gives the same response until something
+                # changes, and its ETag is worth keeping. Otherwise the next
+                # request will be a different one.
+                self._set_sync(latest, first_etag if latest == since else None)
+
+    def _store(self, number, id, title, body, labels, state, updated_at):
+        language, video_title, video_id = parse_issue(title, body)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO issues (repository, %s) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % ISSUE_COLUMNS,
+            (self.repository, number, id, title, language, video_title,
+             video_id, json.dumps(labels), state, updated_at)
+        )
+
+    def _store_data(self, data):
+        self._store(
+            data['number'], data['id'], data['title'], data['body'],
+            [label['name'] for label in data['labels']],
+            data['state'], data['updated_at']
+        )
+
+    def _get_sync(self):
+        row = self.connection.execute(
+            "SELECT since, etag FROM syncs WHERE repository = ?",
+            (self.repository,)
+        ).fetchone()
+        return row if row else (None, None)
+
+    def _set_sync(self, since, etag):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO syncs (repository, since, etag) "
+            "VALUES (?, ?, ?)", (self.repository, since, etag)
+        )
+
+    @staticmethod
+    def _get_next_page_url(response_headers):
+        m = NEXT_PAGE_REGEX.search(response_headers.get('link', ''))
+        return m.group(1) if m else None
+
+    @staticmethod
+    def _to_issue(row):
+        row = list(row)
+        row[6] = json.loads(row[6]) if row[6] else []
+        return Issue(*row)
+
+
+def get_issue_index(repository):
+    """
+    Returns the index of the issues of the repository shared by the whole
+    process. It is NOT refreshed, call refresh() to sync it with GitHub.
+    """
+    with _indexes_lock:
+        if repository not in _indexes:
+            _indexes[repository] = IssueIndex(repository)
+        return _indexes[repository]
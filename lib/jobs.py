@@ -0,0 +1,267 @@
+# coding=utf-8
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+from lib.retry import backoff_delay
+
+log = logging.getLogger('Jobs')
+
+
+###############################################################################
+
+JOBS_DATABASE_FILE = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'var', 'jobs.sqlite'
+))
+
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    locked_until REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_key ON jobs (kind, key);
+CREATE INDEX IF NOT EXISTS jobs_by_availability ON jobs (available_at);
+"""
+
+# Seconds a worker may spend on a job before another worker takes it over,
+# believing the first one died.
+JOB_LEASE = 300
+
+# How many times we try a job before giving up on it.
+JOB_MAX_ATTEMPTS = 8
+
+# Seconds. Failed jobs are retried with an exponential backoff up to that.
+JOB_MAX_DELAY = 600
+
+# Seconds a worker waits before looking for jobs again, when there are none.
+# It is woken up sooner by the jobs enqueued by its own process.
+POLL_INTERVAL = 5
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+# MODEL #######################################################################
+
+class Job(object):
+
+    __slots__ = ('id', 'kind', 'key', 'payload', 'attempts')
+
+    def __init__(self, id, kind, key, payload, attempts):
+        self.id = id
+        self.kind = kind
+        self.key = key
+        self.payload = payload
+        self.attempts = attempts
+
+
+###############################################################################
+
+class JobQueue:
+    """
+    A durable queue of jobs, in a SQLite database, shared by the processes
+    of the web bot, so that the webhooks can answer right away and leave the
+    work to a background worker.
+
+    Jobs of the same kind and key are coalesced : enqueuing a job while one
+    with the same key is still pending replaces the payload of the pending
+    one, so that only the latest state is processed, eg. the last column a
+    card was moved to.
+    """
+
+    def __init__(self, path=JOBS_DATABASE_FILE):
+        self.path = path
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        # We handle the transactions ourselves, with BEGIN IMMEDIATE, so that
+        # two processes never take the same job.
+        self.connection = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False,
+            isolation_level=None
+        )
+        self.connection.executescript(JOBS_SCHEMA)
+        self.lock = threading.RLock()
+        self.enqueued = threading.Event()
+
+    def enqueue(self, kind, key, payload):
+        """
+        Adds a job, or updates the payload of the pending job of that key.
+        :param payload: anything JSON can serialize
+        """
+        payload = json.dumps(payload)
+        with self._transaction() as cursor:
+            # A new event is not a retry : it is due now, with no attempts.
+            cursor.execute(
+                "UPDATE jobs SET payload = ?, attempts = 0, available_at = ? "
+                "WHERE kind = ? AND key = ? AND locked_until IS NULL",
+                (payload, time.time(), kind, str(key))
+            )
+            if cursor.rowcount == 0:
+                cursor.execute(
+                    "INSERT INTO jobs (kind, key, payload, available_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (kind, str(key), payload, time.time())
+                )
+        self.enqueued.set()
+
+    def take(self):
+        """
+        Returns the oldest job ready to be processed, leasing it to us, or
+        None if there is none. Call done() or failed() once processed.
+        Jobs whose key has a job being processed wait for it, so that the
+        jobs of a key run one after the other, in order.
+        """
+        now = time.time()
+        with self._transaction() as cursor:
+            row = cursor.execute(
+                "SELECT id, kind, key, payload, attempts FROM jobs AS job "
+                "WHERE available_at <= ? "
+                "AND (locked_until IS NULL OR locked_until < ?) "
+                "AND NOT EXISTS (SELECT 1 FROM jobs AS other "
+                "WHERE other.kind = job.kind AND other.key = job.key "
+                "AND other.id != job.id AND other.locked_until >= ?) "
+                "ORDER BY available_at, id LIMIT 1",
+                (now, now, now)
+            ).fetchone()
+            if row is None:
+                return None
+            cursor.execute(
+                "UPDATE jobs SET locked_until = ? WHERE id = ?",
+                (now + JOB_LEASE, row[0])
+            )
+        return Job(row[0], row[1], row[2], json.loads(row[3]), row[4])
+
+    def done(self, job):
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+
+    def failed(self, job):
+        """
+        Makes the job available again later, unless we tried it too many
+        times already, or a newer job with the same key supersedes it.
+        """
+        attempts = job.attempts + 1
+        with self._transaction() as cursor:
+            newer = cursor.execute(
+                "SELECT COUNT(*) FROM jobs WHERE kind = ? AND key = ? "
+                "AND id > ?", (job.kind, job.key, job.id)
+            ).fetchone()[0]
+            if newer or attempts >= JOB_MAX_ATTEMPTS:
+                if not newer:
+                    log.error("Giving up on job %s %s after %d attempts."
+                              % (job.kind, job.key, attempts))
+                cursor.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+                return
+            cursor.execute(
+                "UPDATE jobs SET attempts = ?, available_at = ?, "
+                "locked_until = NULL WHERE id = ?",
+                (attempts, time.time() + backoff_delay(
+                    attempts, max_delay=JOB_MAX_DELAY
+                ), job.id)
+            )
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM jobs"
+            ).fetchone()[0]
+
+    # INTERNALS ###############################################################
+
+    def _transaction(self):
+        return _Transaction(self)
+
+
+class _Transaction:
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def __enter__(self):
+        self.queue.lock.acquire()
+        try:
+            self.cursor = self.queue.connection.cursor()
+            self.cursor.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self.queue.lock.release()
+            raise
+        return self.cursor
+
+    def __exit__(self, exception_type, exception, traceback):
+        try:
+            if exception_type is None:
+                self.cursor.execute("COMMIT")
+            else:
+                self.cursor.execute("ROLLBACK")
+        finally:
+            self.queue.lock.release()
+        return False
+
+
+###############################################################################
+
+class JobWorker(threading.Thread):
+    """
+    A background thread processing the jobs of a queue, one at a time, with
+    the handler of their kind, a callable taking the payload of the job.
+    A job whose handler raises is retried later.
+    """
+
+    def __init__(self, queue, handlers):
+        threading.Thread.__init__(self, name='JobWorker')
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                job = self.queue.take()
+            except sqlite3.Error as e:
+                log.error("Could not take a job : %s" % e)
+                job = None
+            if job is None:
+                self.queue.enqueued.wait(POLL_INTERVAL)
+                self.queue.enqueued.clear()
+                continue
+            self.process(job)
+
+    def process(self, job):
+        handler = self.handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise ValueError("No handler for jobs of kind %s" % job.kind)
+            handler(job.payload)
+        except Exception as e:
+            log.exception("Job %s %s failed : %s" % (job.kind, job.key, e))
+            self.queue.failed(job)
+        else:
+            self.queue.done(job)
+
+    def stop(self):
+        self.stopped.set()
+        self.queue.enqueued.set()
+
+
+def get_job_queue(path=JOBS_DATABASE_FILE):
+    """
+    Returns the job queue stored at path, shared by the whole process.
+    """
+    with _queues_lock:
+        if path not in _queues:
+            _queues[path] = JobQueue(path)
+        return _queues[path]
@@ -0,0 +1,129 @@
+# coding=utf-8
+import os
+import json
+import logging
+import threading
+
+from lib.files import get_state_path, make_directory_of
+
+log = logging.getLogger('Journal')
+
+
+###############################################################################
+
+# The journal is stored in our var/ directory, like the index, so that a run
+# can be resumed even after the daily cron cloned the captions again.
+JOURNAL_FILE_SUFFIX = '.journal'
+
+# How many records to write before making sure they reached the disk.
+# Records are flushed to the system right away, so they survive a crash of
+# the process, only a crash of the machine may lose the last ones.
+SYNC_EVERY = 32
+
+
+def get_journal_path(captions_directory):
+    return get_state_path(captions_directory, JOURNAL_FILE_SUFFIX)
+
+
+###############################################################################
+
+class Journal:
+    """
+    An append-only journal of the work done during a run, one JSON record
+    per line, so that a run that crashed or ran out of quota can be resumed
+    by a later run, skipping the work already done.
+    Records are dicts with at least a 'type', eg. {'type': 'video', 'id': ..}
+    """
+
+    def __init__(self, path, sync_every=SYNC_EVERY):
+        self.path = path
+        self.sync_every = sync_every
+        self.records = []
+        self.unsynced = 0
+        self.file = None
+        self.lock = threading.Lock()
+
+    def open(self, resume=False):
+        """
+        Opens the journal for writing.
+        When resuming, the records of the previous run are loaded and kept,
+        otherwise the journal starts afresh.
+        """
+        self.records = []
+        make_directory_of(self.path)
+        if resume:
+            self.records = self._read()
+            self.file = open(self.path, 'a')
+            if self._is_torn():
+                self.file.write("\n")  # do not append to the torn line
+        else:
+            self.file = open(self.path, 'w')
+        return self
+
+    def record(self, _type, **data):
+        data['type'] = _type
+        line = json.dumps(data, separators=(',', ':'))
+        with self.lock:
+            self.records.append(data)
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self._sync()
+                self.file.close()
+                self.file = None
+
+    def remove(self):
+        """
+        Closes and deletes the journal, once the run is complete.
+        """
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def of_type(self, _type):
+        return [r for r in self.records if r['type'] == _type]
+
+    def ids_of_type(self, _type):
+        return set([r['id'] for r in self.records if r['type'] == _type])
+
+    # INTERNALS ###############################################################
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def _is_torn(self):
+        try:
+            with open(self.path, 'rb') as journal_file:
+                journal_file.seek(0, os.SEEK_END)
+                if journal_file.tell() == 0:
+                    return False
+                journal_file.seek(-1, os.SEEK_END)
+                return journal_file.read(1) != b"\n"
+        except IOError:
+            return False
+
+    def _read(self):
+        records = []
+        try:
+            with open(self.path, 'r') as journal_file:
+                for line in journal_file:
+                    if not line.strip():
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # The last line may be torn by a crash.
+                        log.warn("Ignoring a malformed line of journal '%s'."
+                                 % self.path)
+        except IOError:
+            pass
+        return records
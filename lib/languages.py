@@ -0,0 +1,99 @@
+# coding=utf-8
+import os
+import yaml
+import threading
+
+from jinja2 import Environment, FileSystemLoader, StrictUndefined
+
+from lib.dates import format_day
+
+
+###############################################################################
+
+CONFIG_DIRECTORY = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'config'
+))
+
+LANGUAGES_FILE = os.path.join(CONFIG_DIRECTORY, 'languages.yml')
+
+ISSUE_TEMPLATES_DIRECTORY = os.path.join(CONFIG_DIRECTORY, 'issues')
+
+DEFAULT_ISSUE_TEMPLATE = 'issue.md.jinja2'
+
+_issue_templates = None
+_issue_templates_lock = threading.Lock()
+
+
+def load_languages(path=LANGUAGES_FILE):
+    """
+    Returns the list of the languages defined in the YAML file at path,
+    as dicts, see config/languages.yml.
+    """
+    with open(path, 'r') as languages_file:
+        languages = yaml.safe_load(languages_file)
+    for language in languages:
+        language.setdefault('template', DEFAULT_ISSUE_TEMPLATE)
+        language.setdefault('date', 'en')
+        language.setdefault('info_rule', None)
+        language['column'] = str(language['column'])
+    return languages
+
+
+###############################################################################
+
+class IssueTemplates:
+    """
+    Renders the bodies of the issues of the videos, in each language.
+    Each template is compiled once, when it is first used, and is shared by
+    all the languages that use it, so adding a language is only adding
+    its words to the configuration.
+    """
+
+    def __init__(self, directory=ISSUE_TEMPLATES_DIRECTORY):
+        self.environment = Environment(
+            loader=FileSystemLoader([directory]),
+            trim_blocks=True,
+            lstrip_blocks=True,
+            keep_trailing_newline=True,
+            undefined=StrictUndefined,
+            auto_reload=False,
+        )
+        self.templates = {}  # template name => compiled template
+        self.lock = threading.Lock()
+
+    def get_template(self, name):
+        with self.lock:
+            template = self.templates.get(name)
+            if template is None:
+                template = self.environment.get_template(name)
+                self.templates[name] = template
+            return template
+
+    def render_languages(self, video, languages):
+        """
+        Yields tuples (language, body of the issue of the video in that
+        language), for each of the languages.
+        """
+        days = {}  # language of the date => formatted day of the video
+        for language in languages:
+            date_language = language['date']
+            if date_language not in days:
+                days[date_language] = format_day(video.date, date_language)
+            template = self.get_template(language['template'])
+            yield language, template.render(
+                video=video,
+                language=language,
+                words=language['words'],
+                day=days[date_language],
+            )
+
+
+def get_issue_templates():
+    """
+    Returns the issue templates shared by the whole process.
+    """
+    global _issue_templates
+    with _issue_templates_lock:
+        if _issue_templates is None:
+            _issue_templates = IssueTemplates()
+        return _issue_templates
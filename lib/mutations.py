@@ -0,0 +1,107 @@
+# coding=utf-8
+import logging
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger('Mutations')
+
+
+###############################################################################
+
+# How many mutations we send to GitHub at once. GitHub asks to not make
+# concurrent requests, and its secondary rate limits catch those who do too
+# much, so we keep it low ; the requests wait when GitHub tells them to.
+MUTATION_JOBS = 4
+
+
+# MODEL #######################################################################
+
+class Mutation(object):
+    """
+    The outcome of an operation run by the MutationExecutor.
+    """
+
+    __slots__ = ('description', 'result', 'error', 'done')
+
+    def __init__(self, description):
+        self.description = description
+        self.result = None
+        self.error = None
+        self.done = False
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    @property
+    def outcome(self):
+        if not self.done:
+            return u"pending"
+        if self.failed:
+            return u"FAILED (%s)" % self.error
+        return u"done"
+
+
+###############################################################################
+
+class MutationExecutor:
+    """
+    Runs the operations changing things on GitHub, like creating issues and
+    cards or moving cards, in a bounded pool of threads.
+
+    An operation failing does not stop the others, its error is recorded in
+    its Mutation. Operations may submit other operations, that depend on
+    their result, eg. creating the card of the issue they created.
+    Retries and rate limits are handled by lib.github.request_api.
+    """
+
+    def __init__(self, jobs=MUTATION_JOBS):
+        self.pool = ThreadPool(jobs)
+        self.mutations = []
+        self.pending = 0
+        self.condition = threading.Condition()
+
+    def submit(self, description, function, *args, **kwargs):
+        """
+        Runs function(*args, **kwargs) in the pool.
+        :return: the Mutation, to check its outcome once done
+        """
+        mutation = Mutation(description)
+        with self.condition:
+            self.mutations.append(mutation)
+            self.pending += 1
+        self.pool.apply_async(
+            self._run, (mutation, function, args, kwargs)
+        )
+        return mutation
+
+    def wait(self):
+        """
+        Waits for all the operations, including the ones they submitted,
+        and stops the pool.
+        :return: the list of all the Mutations, in the order of submission
+        """
+        with self.condition:
+            while self.pending:
+                self.condition.wait(1)
+        self.pool.close()
+        self.pool.join()
+        return self.mutations
+
+    def failures(self):
+        return [m for m in self.mutations if m.done and m.failed]
+
+    # INTERNALS ###############################################################
+
+    def _run(self, mutation, function, args, kwargs):
+        try:
+            mutation.result = function(*args, **kwargs)
+        except Exception as e:
+            log.error("%s failed : %s" % (mutation.description, e))
+            mutation.error = e
+        finally:
+            mutation.done = True
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
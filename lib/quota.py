@@ -0,0 +1,188 @@
+# coding=utf-8
+import os
+import json
+import time
+import fcntl
+import datetime
+import threading
+
+
+###############################################################################
+
+QUOTA_LEDGER_FILE = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'var', 'quota.json'
+))
+
+# Units of quota spent by each call to the YouTube Data API, per endpoint.
+# https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_COSTS = {
+    'channels': 1,
+    'playlistItems': 1,
+    'videos': 1,
+    'search': 100,
+    'captions': 50,
+    'captions.download': 200,
+    'captions.update': 450,
+}
+
+# Cost of the endpoints missing above, to be on the safe side.
+DEFAULT_QUOTA_COST = 100
+
+# Units we allow ourselves to spend per day, all scripts included.
+# Keep it under the quota of the project in the Google API Console.
+DAILY_BUDGET = 1000000
+
+# At most that many calls per second, to not trigger the per-user rate limit.
+MAX_CALLS_PER_SECOND = 10.0
+
+# The quota is reset at midnight, Pacific Time. We ignore daylight saving,
+# so we may believe the day changed one hour late, which is the safe side.
+QUOTA_TIMEZONE_OFFSET = datetime.timedelta(hours=-8)
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+###############################################################################
+
+class QuotaLedger:
+    """
+    Accounts for the units of YouTube API quota we spend, in a file shared by
+    all our scripts, and throttles the calls :
+    - to a budget of units per day, raising QuotaExceeded beyond,
+    - to a maximum number of calls per second, by waiting.
+    Call acquire() before each request to the API.
+    """
+
+    def __init__(self, path=QUOTA_LEDGER_FILE, budget=DAILY_BUDGET,
+                 rate=MAX_CALLS_PER_SECOND):
+        self.path = path
+        self.budget = budget
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call_at = 0
+        self.lock = threading.Lock()
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    @staticmethod
+    def cost(endpoint):
+        return QUOTA_COSTS.get(endpoint, DEFAULT_QUOTA_COST)
+
+    @staticmethod
+    def today():
+        now = datetime.datetime.utcnow() + QUOTA_TIMEZONE_OFFSET
+        return now.strftime("%Y-%m-%d")
+
+    def acquire(self, endpoint):
+        """
+        Waits for our turn to call the endpoint, and records its cost.
+        :raises QuotaExceeded: when the call would exceed the daily budget.
+        """
+        cost = self.cost(endpoint)
+
+        def _spend(ledger):
+            if ledger['used'] + cost > self.budget:
+                raise QuotaExceeded(
+                    "Calling %s would cost %d units, and we already spent "
+                    "%d out of our %d units for today." % (
+                        endpoint, cost, ledger['used'], self.budget
+                    )
+                )
+            ledger['used'] += cost
+            ledger['calls'][endpoint] = ledger['calls'].get(endpoint, 0) + 1
+            ledger['units'][endpoint] = ledger['units'].get(endpoint, 0) + cost
+
+        self._update(_spend)
+        self._wait_for_turn()
+        return cost
+
+    def remaining(self):
+        return self.budget - self.usage()['used']
+
+    def usage(self):
+        """
+        Returns the ledger of today, a dict with the total 'used' units,
+        and the 'calls' count and 'units' spent per endpoint.
+        """
+        return self._update(None)
+
+    # INTERNALS ###############################################################
+
+    def _wait_for_turn(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            call_at = max(now, self.next_call_at)
+            self.next_call_at = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+    def _update(self, callback):
+        """
+        Reads the ledger of today, passes it to the callback to modify it if
+        there is one, and writes it back, while holding a lock on the file so
+        that our scripts running concurrently do not lose any update.
+        """
+        with self.lock:
+            with open("%s.lock" % self.path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    ledger = self._read()
+                    if callback is not None:
+                        callback(ledger)
+                        self._write(ledger)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        ledger['budget'] = self.budget
+        return ledger
+
+    def _read(self):
+        today = self.today()
+        try:
+            with open(self.path, 'r') as ledger_file:
+                ledger = json.load(ledger_file)
+        except (IOError, ValueError):
+            ledger = None
+        if ledger is None or ledger.get('day') != today:
+            ledger = {'day': today, 'used': 0, 'calls': {}, 'units': {}}
+        return ledger
+
+    def _write(self, ledger):
+        temporary_path = "%s.tmp" % self.path
+        with open(temporary_path, 'w') as ledger_file:
+            json.dump(ledger, ledger_file, indent=2, sort_keys=True)
+        os.rename(temporary_path, self.path)
+
+
+def get_quota_ledger():
+    """
+    Returns the quota ledger shared by the whole process.
+    """
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = QuotaLedger()
+        return _ledger
+
+
+def configure_quota(budget=None, rate=None):
+    """
+    Changes the daily budget and the maximum calls per second of the ledger
+    shared by the whole process.
+    """
+    ledger = get_quota_ledger()
+    if budget is not None:
+        ledger.budget = budget
+    if rate is not None:
+        ledger.interval = 1.0 / rate if rate else 0
+    return ledger
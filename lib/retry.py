@@ -0,0 +1,77 @@
+# coding=utf-8
+import time
+import random
+import logging
+
+log = logging.getLogger('Retry')
+
+
+###############################################################################
+
+# How many times we try a call before giving up.
+MAX_ATTEMPTS = 6
+
+# Seconds. The n-th retry waits up to BASE_DELAY * 2^n, but never more than
+# MAX_DELAY, and a random part of that so that workers do not retry in sync.
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+# HTTP statuses that are worth retrying : too many requests, server errors.
+RETRIABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RetriableResponse(Exception):
+    """
+    Raised from within a call to make it retried because of its response.
+    When we give up, it is raised with the last response.
+    """
+
+    def __init__(self, response, retry_after=None):
+        Exception.__init__(self, "HTTP %s" % response.status_code)
+        self.response = response
+        self.retry_after = retry_after
+
+
+###############################################################################
+
+def backoff_delay(attempt, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    """
+    Exponential backoff with full jitter, in seconds, for the attempt-th
+    retry, starting at zero.
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def is_retriable_status(status):
+    return status in RETRIABLE_STATUSES
+
+
+def call_with_retries(function, is_retriable, attempts=MAX_ATTEMPTS,
+                      description=None, base_delay=BASE_DELAY,
+                      max_delay=MAX_DELAY):
+    """
+    Calls function() and returns what it returns.
+    When it raises an exception and is_retriable(exception) is true, waits a
+    bit and calls it again, up to attempts times. Otherwise, or when we give
+    up, the exception is raised.
+    is_retriable may also return a number of seconds to wait before retrying,
+    when the server told us how long to wait.
+    """
+    attempt = 0
+    while True:
+        try:
+            return function()
+        except Exception as e:
+            retriable = is_retriable(e)
+            attempt += 1
+            if not retriable or attempt >= attempts:
+                raise
+            if retriable is True:
+                delay = backoff_delay(attempt - 1, base_delay, max_delay)
+            else:
+                delay = float(retriable)
+            log.warn("%s failed (%s), retrying in %.1fs (%d/%d)..." % (
+                description or getattr(function, '__name__', 'Call'),
+                e, delay, attempt, attempts - 1
+            ))
+            time.sleep(delay)
@@ -0,0 +1,76 @@
+# coding=utf-8
+import threading
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+
+###############################################################################
+
+# How many connections to keep alive per host.
+# This should be at least the number of concurrent jobs, or the connections in
+# excess will be closed after each request instead of being reused.
+POOL_SIZE = 10
+
+# Seconds to wait for the server to send bytes before giving up.
+TIMEOUT = 30
+
+# Google only compresses the responses if the User-Agent mentions gzip.
+USER_AGENT = "bot.insoumis.online (gzip)"
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+###############################################################################
+
+class PooledSession(Session):
+    """
+    A requests Session keeping its connections alive in a pool, asking for
+    compressed responses, and with a default timeout.
+    It is shared by all the threads of the process.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, timeout=TIMEOUT):
+        Session.__init__(self)
+        self.timeout = timeout
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'User-Agent': USER_AGENT,
+        })
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return Session.request(self, method, url, **kwargs)
+
+
+def get_session(name='default'):
+    """
+    Returns the shared session of that name, creating it on first use.
+    Use one name per remote API, so that they have their own pool.
+    """
+    with _sessions_lock:
+        if name not in _sessions:
+            _sessions[name] = PooledSession(POOL_SIZE, TIMEOUT)
+        return _sessions[name]
+
+
+def configure_sessions(pool_size=None, timeout=None):
+    """
+    Changes the settings of the sessions created from now on, and drops the
+    existing ones so that they get created again with the new settings.
+    """
+    global POOL_SIZE, TIMEOUT
+    with _sessions_lock:
+        if pool_size is not None:
+            POOL_SIZE = pool_size
+        if timeout is not None:
+            TIMEOUT = timeout
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
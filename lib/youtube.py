@@ -17,14 +17,15 @@
 ###############################################################################
 
 import os
-import re
+import json
+import socket
 import datetime
 import dateutil.parser
-import locale
 import isodate
-import strict_rfc3339
 import httplib2
 
+from dateutil.tz import tzutc
+from multiprocessing.pool import ThreadPool
 from colorama import init
 from termcolor import colored, cprint
 
@@ -34,9 +35,18 @@ from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 from oauth2client.tools import argparser, run_flow
 
-from requests import get
+from requests.exceptions import ConnectionError as RequestsConnectionError, \
+    Timeout
 from slugify import slugify
 
+from lib.cache import get_response_cache
+from lib.quota import get_quota_ledger
+from lib.retry import call_with_retries, is_retriable_status, \
+    RetriableResponse
+from lib.session import get_session
+from lib.headers import read_caption_header
+from lib.dates import format_day
+
 
 ###############################################################################
 
@@ -126,6 +136,16 @@ def get_authenticated_service(_args):
     """
     Authorize the request and store the authorization credentials.
     """
+    return build_service(get_credentials(_args))
+
+
+def get_credentials(_args):
+    """
+    Returns the authorization credentials, from their file, or asking for
+    them when there are none.
+    Threads should share them : they refresh them through the same storage,
+    which serializes the refreshes and the writes of the file.
+    """
     flow = flow_from_clientsecrets(CLIENT_SECRETS_FILE,
                                    scope=YOUTUBE_RW_SSL_SCOPE,
                                    message=MISSING_CLIENT_SECRETS_MESSAGE)
@@ -136,6 +156,14 @@ def get_authenticated_service(_args):
     if credentials is None or credentials.invalid:
         credentials = run_flow(flow, storage, _args)
 
+    return credentials
+
+
+def build_service(credentials):
+    """
+    Returns a YouTube service authorized with the credentials, with its own
+    http connection, as httplib2 is not thread-safe.
+    """
     with open(DISCOVERY_DOCUMENT, "r") as f:
         doc = f.read()
         return build_from_document(
@@ -145,143 +173,399 @@ def get_authenticated_service(_args):
 
 # YOUTUBE API REQUESTS ########################################################
 
-def get_latest_videos_of_channel(channel_id, cap=10, since_minutes_ago=300):
-    assert cap < 51  # 50 is the highest authorized value in 2017
-    t = datetime.datetime.now() - datetime.timedelta(minutes=since_minutes_ago)
-    t = strict_rfc3339.timestamp_to_rfc3339_utcoffset(int(t.strftime("%s")))
-    url = 'https://www.googleapis.com/youtube/v3/search'
+YOUTUBE_API_URL = 'https://www.googleapis.com/youtube/v3'
+
+# The highest authorized value of maxResults in 2017
+VIDEOS_PER_REQUEST = 50
+
+# Partial response selectors, so that we only transfer what we actually parse.
+# See https://developers.google.com/youtube/v3/getting-started#fields
+CHANNELS_FIELDS = "items(contentDetails/relatedPlaylists/uploads)"
+PLAYLIST_ITEMS_FIELDS = "nextPageToken,pageInfo," \
+                        "items(snippet(title,resourceId/videoId)," \
+                        "contentDetails/videoPublishedAt)"
+VIDEOS_FIELDS = "pageInfo," \
+                "items(id,snippet(title,publishedAt),contentDetails/duration)"
+CAPTIONS_FIELDS = "items(id,snippet(language,trackKind,isDraft,lastUpdated))"
+
+
+# Reasons of 403 errors that mean "slow down" and not "stop for today".
+RETRIABLE_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+# Channel id => id of its uploads playlist, that never changes.
+_uploads_playlists = {}
+
+
+def get(resource, parameters):
+    """
+    GETs the resource of the YouTube Data API with the parameters, through
+    the shared session that keeps the connections alive.
+    Responses are cached with their ETag, and when the API tells us that
+    they were not modified since, the cached response is returned.
+    The cost of the call is recorded in the quota ledger beforehand, which
+    raises QuotaExceeded when it is over our daily budget.
+    Transient failures are retried, see is_retriable_error().
+    :param resource: eg. 'videos'
+    :param parameters: dict of query parameters, the API key excepted
+    :return: a requests Response
+    """
+    url = "%s/%s" % (YOUTUBE_API_URL, resource)
+    cache = get_response_cache('youtube')
+    cached = cache.get(url, parameters)
+
+    headers = {}
+    if cached is not None:
+        headers['If-None-Match'] = cached['etag']
+
+    parameters = dict(parameters)
+    parameters['key'] = YOUTUBE_API_KEY
+
+    def _get():
+        get_quota_ledger().acquire(resource)
+        _response = get_session('youtube').get(
+            url, params=parameters, headers=headers
+        )
+        if is_retriable_response(_response.status_code, _response.content):
+            raise RetriableResponse(
+                _response, _retry_after(_response.headers.get('Retry-After'))
+            )
+        return _response
+
+    try:
+        response = call_with_retries(
+            _get, is_retriable_error, description="GET %s" % resource
+        )
+    except RetriableResponse as e:
+        response = e.response  # we gave up, let the caller handle it
+
+    if response.status_code == 304 and cached is not None:
+        del parameters['key']
+        cache.revalidate(url, parameters, cached)
+        response.status_code = 200
+        response.reason = 'OK (cached)'
+        response.encoding = 'utf-8'
+        response._content = cached['body'].encode('utf-8')
+        response.from_cache = True
+    elif response.ok and response.headers.get('ETag'):
+        del parameters['key']
+        cache.put(url, parameters, response.headers['ETag'], response.text)
+
+    return response
+
+
+class YoutubeError(Exception):
+    pass
+
+
+def check_response(response):
+    """
+    Raises a YoutubeError if the response is not a successful one.
+    """
+    if not response.ok:
+        raise YoutubeError(
+            "Request to Youtube API failed with response :\n%s"
+            % response.text
+        )
+
+
+def _get_error_reason(content):
+    """
+    Returns the reason of the first error of the body of an error response,
+    like 'quotaExceeded', or None.
+    """
+    try:
+        return json.loads(content)['error']['errors'][0]['reason']
+    except (ValueError, TypeError, KeyError, IndexError):
+        return None
+
+
+def _retry_after(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retriable_response(status, content):
+    """
+    Whether an error response of the YouTube API is worth retrying : server
+    errors, and rate limits that are not about the daily quota.
+    """
+    if is_retriable_status(status):
+        return True
+    if status == 403:
+        return _get_error_reason(content) in RETRIABLE_REASONS
+    return False
+
+
+def is_retriable_error(error):
+    """
+    Whether an exception raised while calling the YouTube API is transient.
+    This covers the REST calls and the calls made by googleapiclient.
+    :return: False, True, or the seconds to wait before retrying
+    """
+    if isinstance(error, RetriableResponse):
+        return error.retry_after or True
+    if isinstance(error, HttpError):
+        return is_retriable_response(error.resp.status, error.content)
+    if isinstance(error, (RequestsConnectionError, Timeout, socket.error,
+                          httplib2.HttpLib2Error)):
+        return True
+    return False
+
+
+def get_uploads_playlist_of_channel(channel_id):
+    """
+    Returns the id of the playlist of all the videos uploaded to the channel.
+    Listing it costs 1 unit of quota per page, where searching costs 100.
+    """
+    if channel_id in _uploads_playlists:
+        return _uploads_playlists[channel_id]
+
     parameters = {
-        'key': YOUTUBE_API_KEY,
-        'channelId': channel_id,
-        'type': 'video',
-        'part': 'snippet',
-        'order': 'date',
-        'publishedAfter': t,  # RFC 3339 with trailing Z, or it will not work
-        'maxResults': '%d' % cap,
+        'id': channel_id,
+        'part': 'contentDetails',
+        'fields': CHANNELS_FIELDS,
     }
 
-    response = get(url, params=parameters)
+    response = get('channels', parameters)
 
-    if not response.ok:
-        cprint("Request to Youtube API failed with response :", "red")
-        print(response.text)
-        exit(1)
+    check_response(response)
 
-    return response.json()
+    items = response.json().get('items', [])
+    if not items:
+        raise YoutubeError("Channel %s was not found." % channel_id)
+
+    playlist_id = items[0]['contentDetails']['relatedPlaylists']['uploads']
+    _uploads_playlists[channel_id] = playlist_id
+
+    return playlist_id
+
+
+def get_latest_videos_of_channel(channel_id, cap=10, since_minutes_ago=300):
+    """
+    Lists the videos of the channel published less than since_minutes_ago
+    minutes ago, among the cap latest uploads.
+    """
+    t = datetime.datetime.now(tzutc()) \
+        - datetime.timedelta(minutes=since_minutes_ago)
+
+    _json = get_videos_of_channel(channel_id, cap=cap)
+    items = []
+    for item in _json['items']:
+        # Private and deleted uploads have no publication date.
+        published_at = item.get('contentDetails', {}).get('videoPublishedAt')
+        if published_at is None:
+            continue
+        if dateutil.parser.parse(published_at) > t:
+            items.append(item)
+    _json['items'] = items
+    _json.pop('nextPageToken', None)
+
+    return _json
 
 
 def get_videos_of_channel(channel_id, page=None, cap=50):
+    """
+    Lists one page of the uploads of the channel, latest first.
+    """
     assert cap < 51  # 50 is the highest authorized value in 2017
-    url = 'https://www.googleapis.com/youtube/v3/search'
     parameters = {
-        'key': YOUTUBE_API_KEY,
-        'channelId': channel_id,
-        'type': 'video',
-        'part': 'snippet',
-        'order': 'date',
+        'playlistId': get_uploads_playlist_of_channel(channel_id),
+        'part': 'snippet,contentDetails',
+        'fields': PLAYLIST_ITEMS_FIELDS,
         'maxResults': '%d' % cap,
     }
 
     if page is not None:
         parameters['pageToken'] = page
 
-    response = get(url, params=parameters)
+    response = get('playlistItems', parameters)
 
-    if not response.ok:
-        cprint("Request to Youtube API failed with response :", "red")
-        print(response.text)
-        exit(1)
+    check_response(response)
 
     return response.json()
 
 
-def get_videos(video_ids):
-    url = 'https://www.googleapis.com/youtube/v3/videos'
+def iterate_videos_of_channel(channel_id, page=None, is_known=None):
+    """
+    Yields the pages of the uploads of the channel, latest first, as tuples
+    (videos, next_page_token).
+    Each next page is requested in the background as soon as we have its
+    token, so that it downloads while the caller handles the current page.
+    :param page: token of the page to start with, if not the first one.
+    :param is_known: a callable telling whether a video id is already known.
+        When provided, we stop at the first known video, excluded.
+    """
+    pool = ThreadPool(1)
+    try:
+        pending = pool.apply_async(get_videos_of_channel, (channel_id, page))
+        while pending is not None:
+            _json = pending.get()
+            next_page = _json.get('nextPageToken')
+            pending = None
+            if next_page is not None:
+                pending = pool.apply_async(
+                    get_videos_of_channel, (channel_id, next_page)
+                )
+
+            videos = parse_videos_from_json(_json)
+            if is_known is not None:
+                for i, video in enumerate(videos):
+                    if is_known(video.yid):
+                        yield videos[:i], None
+                        return
+
+            yield videos, next_page
+    finally:
+        pool.terminate()
+
+
+def get_videos(video_ids, jobs=4):
+    """
+    Fetches the snippet and content details of the videos.
+    Duplicate ids are requested only once, and the ids are sent in chunks of
+    VIDEOS_PER_REQUEST, concurrently when there are more than one chunk.
+    :param video_ids: list of YouTube video ids
+    :param jobs: maximum number of concurrent requests
+    :return: a response-like dict whose items follow the order of video_ids
+    """
+    unique_ids = []
+    seen_ids = set()
+    for video_id in video_ids:
+        if video_id not in seen_ids:
+            seen_ids.add(video_id)
+            unique_ids.append(video_id)
+
+    chunks = [
+        unique_ids[i:i + VIDEOS_PER_REQUEST]
+        for i in range(0, len(unique_ids), VIDEOS_PER_REQUEST)
+    ]
+
+    if len(chunks) > 1:
+        pool = ThreadPool(min(jobs, len(chunks)))
+        try:
+            responses = pool.map(_get_videos_chunk, chunks)
+        finally:
+            pool.terminate()
+    else:
+        responses = [_get_videos_chunk(chunk) for chunk in chunks]
+
+    items_by_id = {}
+    for response in responses:
+        for item in response.get('items', []):
+            items_by_id[item['id']] = item
+    items = [items_by_id[_id] for _id in unique_ids if _id in items_by_id]
+
+    return {
+        'kind': 'youtube#videoListResponse',
+        'pageInfo': {
+            'totalResults': len(items),
+            'resultsPerPage': len(items),
+        },
+        'items': items,
+    }
+
+
+def _get_videos_chunk(video_ids):
+    assert len(video_ids) <= VIDEOS_PER_REQUEST
     parameters = {
-        'key': YOUTUBE_API_KEY,
         'id': ','.join(video_ids),
         'part': 'snippet,contentDetails',
-        'maxResults': '50',
+        'fields': VIDEOS_FIELDS,
+        'maxResults': '%d' % VIDEOS_PER_REQUEST,
     }
 
-    response = get(url, params=parameters)
+    response = get('videos', parameters)
 
-    if not response.ok:
-        cprint("Request to Youtube API failed with response :", "red")
-        print(response.text)
+    check_response(response)
 
     return response.json()
 
 
 def get_captions_for_video(video_id):
-    url = 'https://www.googleapis.com/youtube/v3/captions'
     parameters = {
-        'key': YOUTUBE_API_KEY,
         'videoId': video_id,
         'part': 'snippet',
+        'fields': CAPTIONS_FIELDS,
     }
 
-    response = get(url, params=parameters)
+    response = get('captions', parameters)
 
-    if not response.ok:
-        cprint("Request to Youtube API failed with response :", "red")
-        cprint(response.text, "red")
+    check_response(response)
 
     return response.json()
 
 
 def upload_caption(_youtube, _id, _file):
-    return _youtube.captions().update(
-        part="id",
-        body=dict(
-            id=_id
-        ),
-        media_body=_file,
-        media_mime_type='test/vtt'
-    ).execute()
+    def _upload():
+        get_quota_ledger().acquire('captions.update')
+        return _youtube.captions().update(
+            part="id",
+            body=dict(
+                id=_id
+            ),
+            media_body=_file,
+            media_mime_type='test/vtt'
+        ).execute()
+
+    return call_with_retries(
+        _upload, is_retriable_error, description="Upload of %s" % _id
+    )
 
 
 def get_caption(_youtube, caption_id, caption_extension):
-    return _youtube.captions().download(
-        id=caption_id,
-        tfmt=caption_extension
-    ).execute().decode('utf-8')
+    return get_caption_data(
+        _youtube, caption_id, caption_extension
+    ).decode('utf-8')
+
+
+def get_caption_data(_youtube, caption_id, caption_extension):
+    """
+    Downloads the caption, and returns its raw UTF-8 bytes.
+    """
+    def _download():
+        get_quota_ledger().acquire('captions.download')
+        return _youtube.captions().download(
+            id=caption_id,
+            tfmt=caption_extension
+        ).execute()
+
+    return call_with_retries(
+        _download, is_retriable_error,
+        description="Download of %s" % caption_id
+    )
 
 
 ###############################################################################
 
 def parse_videos_from_json(_json):
-    _videos = []
-    for video_data in _json['items']:
-        _id = video_data['id']
-        if type(_id) is dict:
-            _id = _id['videoId']
-        _duration = None
-        if 'contentDetails' in video_data:
-            _duration = video_data['contentDetails']['duration']
-        _videos.append(Video(
-            yid=_id,
-            title=video_data['snippet']['title'],
-            date=video_data['snippet']['publishedAt'],
-            duration=_duration
-        ))
-    return _videos
+    return Video.from_items(_json['items'])
 
 
 def get_caption_file_by_id(_id, _dir, _ext):
-    for dirpath, dirnames, filenames in os.walk(_dir):
-        for name in filenames:
-            if name.endswith(_ext):
-                _caption = Caption.from_file(os.path.join(dirpath, name))
-                _caption.filename = name
-                if _caption.id == _id:
-                    return _caption
-    raise Exception("Found no caption for id %s" % _id)
+    # Imported here because the index module depends on our models.
+    from lib.index import CaptionIndex
+    index = CaptionIndex.open(_dir, _ext)
+    _caption = index.get(_id)
+    index.save()
+    if _caption is None:
+        raise Exception("Found no caption for id %s" % _id)
+    return _caption
 
 
 # MODEL #######################################################################
 
-class Video:
+class Video(object):
+    """
+    The raw strings given by the API are kept, and only parsed on first
+    access, as most of the videos we list are never looked at closely.
+    """
+
+    __slots__ = (
+        'yid', 'title', 'published_at', 'iso_duration',
+        '_date', '_duration', '_slug',
+    )
 
     def __init__(self, yid, title, date, duration=None):
         """
@@ -292,72 +576,118 @@ class Video:
         """
         self.yid = yid
         self.title = title
-        self.date = dateutil.parser.parse(date)
-        if duration is not None:
-            self.duration = isodate.parse_duration(duration)
-        else:
-            self.duration = None
+        self.published_at = date
+        self.iso_duration = duration
+        self._date = None
+        self._duration = None
+        self._slug = None
+
+    @classmethod
+    def from_items(cls, items):
+        """
+        Returns the list of the Videos of the items of a response of the API,
+        be they playlist items, search results or videos.
+        """
+        videos = []
+        append = videos.append
+        for item in items:
+            snippet = item['snippet']
+            details = item.get('contentDetails')
+            if 'resourceId' in snippet:  # a playlist item
+                published_at = (details or {}).get('videoPublishedAt')
+                if published_at is None:
+                    # A private or deleted upload.
+                    continue
+                append(cls(
+                    snippet['resourceId']['videoId'], snippet['title'],
+                    published_at
+                ))
+                continue
+            _id = item['id']
+            if type(_id) is dict:  # a search result
+                _id = _id['videoId']
+            append(cls(
+                _id, snippet['title'], snippet['publishedAt'],
+                details.get('duration') if details else None
+            ))
+        return videos
 
     def __str__(self):
         return "%s - %s" % (self.yid, self.title)
 
+    @property
+    def date(self):
+        if self._date is None:
+            self._date = dateutil.parser.parse(self.published_at)
+        return self._date
+
+    @property
+    def duration(self):
+        if self._duration is None and self.iso_duration is not None:
+            self._duration = isodate.parse_duration(self.iso_duration)
+        return self._duration
+
     @property
     def slug(self):
-        return slugify(self.title)
+        if self._slug is None:
+            self._slug = slugify(self.title)
+        return self._slug
 
     @property
     def day_fr(self):
-        locale.setlocale(locale.LC_TIME, "fr_FR.utf8")
-        day = self.date.strftime("%A %d %B %Y")
-        locale.resetlocale(locale.LC_TIME)
-        return day.capitalize().decode('utf-8')
+        return format_day(self.date, 'fr')
 
     @property
     def day_en(self):
-        locale.setlocale(locale.LC_TIME, "en_US.utf8")
-        day = self.date.strftime("%A, %d %B %Y")
-        locale.resetlocale(locale.LC_TIME)
-        return day.decode('utf-8')
+        return format_day(self.date, 'en')
 
     @property
     def day_de(self):
-        locale.setlocale(locale.LC_TIME, "de_DE.utf8")
-        day = self.date.strftime("%A %d %B %Y")
-        locale.resetlocale(locale.LC_TIME)
-        return day.decode('utf-8')
+        return format_day(self.date, 'de')
 
 
-class Caption:
+class Caption(object):
 
-    def __init__(self, **kwargs):
-        for key, value in kwargs.items():
-            setattr(self, key, value)
+    __slots__ = (
+        'filepath', 'filename', 'id', 'video_id', 'language', 'last_updated',
+        'content_hash', '_modified_at',
+    )
+
+    def __init__(self, filepath, id, video_id, language, last_updated,
+                 filename=None, content_hash=None):
+        """
+        :param language: <ISO-639-1>[-<ISO-3166>]
+        :param last_updated: RFC 3339
+        :param content_hash: see lib.files.hash_normalized_text
+        """
+        self.filepath = filepath
+        self.filename = filename or os.path.basename(filepath)
+        self.id = id
+        self.video_id = video_id
+        # ISO-639-1 (2 lowercase letters language code),
+        # sometimes followed by a dash - and a
+        # ISO-3166 (2 uppercase letters country code)
+        self.language = language
+        self.last_updated = last_updated
+        self.content_hash = content_hash
+        self._modified_at = None
 
     @staticmethod
     def from_file(filepath):
-        metas = {}
-        regex = re.compile("(\w+): +(.+)")
-        with open(filepath, "r") as open_file:
-            line = open_file.readline()
-            while line and line.strip():  # stop at the first blank line
-                line = open_file.readline()  # also, skip "WebVTT"
-                matches = re.match(regex, line)
-                if matches:
-                    metas[matches.group(1).strip()] = matches.group(2).strip()
-
+        """
+        :raises MalformedCaptionFile: when the file has no proper header.
+        """
+        header = read_caption_header(filepath)
         return Caption(
             filepath=filepath,
-            id=metas['Caption'],
-            video_id=metas['Video'],
-            # ISO-639-1 (2 lowercase letters language code),
-            # sometimes followed by a dash - and a
-            # ISO-3166 (2 uppercase letters country code)
-            language=metas['Language'],  # <ISO-639-1>[-<ISO-3166>]
-            modified_at=dateutil.parser.parse(metas['LastUpdated'])
+            id=header.id,
+            video_id=header.video_id,
+            language=header.language,
+            last_updated=header.last_updated
         )
 
     @property
-    def id(self):
-        if not hasattr(self, 'id'):
-            raise Exception("Caption without ID.")
-        return self.id
+    def modified_at(self):
+        if self._modified_at is None:
+            self._modified_at = dateutil.parser.parse(self.last_updated)
+        return self._modified_at
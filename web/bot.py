@@ -9,19 +9,30 @@ import json
 import hmac
 import yaml
 import random
+import threading
 import datetime
 import logging
 from hashlib import sha1
-from flask import Flask, send_from_directory, request, abort, url_for
+from flask import Flask, send_from_directory, request, abort, url_for, \
+    jsonify
 from jinja2 import Environment, FileSystemLoader
-from github import Github
 from subprocess import check_output, CalledProcessError
 
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
 ROOT_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 if ROOT_DIR not in sys.path:
     sys.path.append(ROOT_DIR)
 
-from lib.github import GITHUB_API_KEY, GITHUB_REPO, LABELS_COLUMNS, LANGUAGES
+from lib.github import GITHUB_REPO, LABELS_COLUMNS, LANGUAGES, request_api, \
+    get_github_client
+from lib.quota import get_quota_ledger
+from lib.issues import get_issue_index
+from lib.board import get_board_index
+from lib.jobs import JobWorker, get_job_queue
 
 
 # PATH RELATIVITY #############################################################
@@ -38,6 +49,9 @@ log = logging.getLogger("Bot")
 log.setLevel(logging.INFO)
 log.addHandler(logging.FileHandler(get_path('bot.log')))
 
+# The job worker logs the jobs that failed there too.
+logging.getLogger('Jobs').addHandler(log.handlers[0])
+
 
 # CONFIG ######################################################################
 
@@ -147,8 +161,127 @@ def render_view(view, context=None):
     )
 
 
+def check_signature(data):
+    """
+    Aborts the request with a 403 unless its X-Hub-Signature header is the
+    HMAC of data with our secret, like GitHub signs the webhooks it sends.
+    """
+    provided_digest = request.headers.get('X-Hub-Signature', default='')
+    h = hmac.new(GITHUB_SECRET, msg=data, digestmod=sha1)
+    expected_digest = "sha1=%s" % h.hexdigest()
+    # if not hmac.compare_digest(provided_digest, expected_digest):
+    # hmac.compare_digest is not available for python 2.7.3
+    # and I'm too lazy/scared to mess with my server.
+    # It's okay if someone uses time attacks to guess our secret.
+    if provided_digest != expected_digest:
+        log.error(u"Hub signature digest mismatch: %s != %s"
+                  % (provided_digest, expected_digest))
+        abort(403)
+
+
+# LABELS ######################################################################
+
+def update_labels_of_card(card):
+    """
+    Updates the labels of the issue of a card to match the column the card
+    was moved to. Run by the job worker, from the events queued by
+    labellize(), so only the latest column of a card moved many times in a
+    row is considered.
+    :param card: a dict with the id, column_id and content_url of the card
+    """
+    card_id = card['id']
+    column_id = card['column_id']
+    content_url = card['content_url']
+    m = re.search("([0-9]+)$", content_url or '')
+    if not m:
+        # It's probably not an issue card, but a standalone card.
+        log.warn(u"No issue id in content url '%s' for card %d."
+                 % (content_url, card_id))
+        return
+    issue_number = int(m.group(1))
+
+    blacklist = [1]
+    if issue_number in blacklist:
+        return
+
+    log.info(u"Moved card %d (issue #%d) to column %d."
+             % (card_id, issue_number, column_id))
+
+    # The labels of the issue are known to the issue index shared with
+    # our scripts, whose refresh is usually one conditional request.
+    # Its first refresh lists all the issues though, which may take longer
+    # than the lease of the job, so we leave that to our scripts.
+    issue_url = "/repos/%s/issues/%d" % (GITHUB_REPO, issue_number)
+    issue_index = get_issue_index(GITHUB_REPO)
+    cached_issue = None
+    if issue_index.is_synced():
+        cached_issue = issue_index.refresh().get(issue_number)
+    if cached_issue is not None:
+        issue_labels = cached_issue.labels
+    else:
+        status, headers, data = request_api("GET", issue_url)
+        issue_labels = [label['name'] for label in data['labels']]
+
+    labels_to_add = []
+    labels_to_remove = []
+    for label, column_ids in LABELS_COLUMNS:
+        if column_id in column_ids and label not in issue_labels:
+            labels_to_add.append(label)
+        if column_id not in column_ids and label in issue_labels:
+            labels_to_remove.append(label)
+
+    for label in labels_to_remove:
+        log.info(u"Removed '%s' from issue #%d" % (label, issue_number))
+        request_api("DELETE", "%s/labels/%s" % (
+            issue_url, quote(label.encode('utf-8'), safe='')
+        ))
+    if labels_to_add:
+        log.info(u"Added '%s' to issue #%d"
+                 % ("', '".join(labels_to_add), issue_number))
+        request_api("POST", "%s/labels" % issue_url, input=labels_to_add)
+
+    if labels_to_add or labels_to_remove:
+        issue_index.set_labels(issue_number, [
+            label for label in issue_labels
+            if label not in labels_to_remove
+        ] + labels_to_add)
+
+
+# JOBS ########################################################################
+
+# The kind of the jobs updating the labels of the issue of a moved card.
+LABELLIZE_JOB = 'labellize'
+
+JOB_HANDLERS = {
+    LABELLIZE_JOB: update_labels_of_card,
+}
+
+_job_worker = None
+_job_worker_lock = threading.Lock()
+
+
+def start_job_worker():
+    """
+    Starts the thread processing the queued jobs, once per process.
+    mod_wsgi may fork the process after loading this module, so we start it
+    lazily, from the first request the process handles, rather than here.
+    """
+    global _job_worker
+    with _job_worker_lock:
+        if _job_worker is None or not _job_worker.is_alive():
+            _job_worker = JobWorker(get_job_queue(), JOB_HANDLERS)
+            _job_worker.start()
+        return _job_worker
+
+
 # ROUTES ######################################################################
 
+@app.before_first_request
+def setup():
+    # The jobs queued before a restart are processed right away.
+    start_job_worker()
+
+
 @app.route('/')
 def home():
     return render_view("home.html.jinja2")
@@ -158,9 +291,13 @@ def home():
 def labellize():
     """
     A github webhook to receive a project_card event.
-    When a project card has been moved, update its associated issue's labels.
+    When a project card has been moved, queue the update of its associated
+    issue's labels, and answer right away : GitHub gives up on deliveries
+    that take more than a few seconds.
     :return:
     """
+    check_signature(request.get_data())
+
     # https://developer.github.com/v3/activity/events/types/#projectcardevent
     payload = request.get_json(silent=True)
     if not payload:
@@ -168,57 +305,21 @@ def labellize():
         abort(400)
     log.debug(u"Received payload:\n%s" % json.dumps(payload, indent=2))
 
-    provided_digest = request.headers.get('X-Hub-Signature', default='')
-    h = hmac.new(GITHUB_SECRET, msg=request.get_data(), digestmod=sha1)
-    expected_digest = "sha1=%s" % h.hexdigest()
-    # if not hmac.compare_digest(provided_digest, expected_digest):
-    # hmac.compare_digest is not available for python 2.7.3
-    # and I'm too lazy/scared to mess with my server.
-    # It's okay if someone uses time attacks to guess our secret.
-    if provided_digest != expected_digest:
-        log.error(u"Hub signature digest mismatch: %s != %s"
-                  % (provided_digest, expected_digest))
-        abort(403)
-
-    if payload['action'] == 'moved':
-        card_id = payload['project_card']['id']
-        column_id = payload['project_card']['column_id']
-        content_url = payload['project_card']['content_url']
-        m = re.search("([0-9]+)$", content_url)
-        if not m:
-            # It's probably not an issue card, but a standalone card.
-            log.warn(u"No issue id in content url '%s' for card %d.",
-                     (content_url, card_id))
-            return ''
-        issue_number = int(m.group(1))
-
-        blacklist = [1]
-        if issue_number in blacklist:
-            return ''
-
-        log.info(u"Moved card %d (issue #%d) to column %d."
-                 % (card_id, issue_number, column_id))
-
-        gh = Github(GITHUB_API_KEY)
-        repo = gh.get_repo(GITHUB_REPO)
-        issue = repo.get_issue(issue_number)
-
-        issue_labels = [label.name for label in issue.labels]
-
-        labels_to_add = []
-        labels_to_remove = []
-        for label, column_ids in LABELS_COLUMNS:
-            if column_id in column_ids and label not in issue_labels:
-                labels_to_add.append(label)
-            if column_id not in column_ids and label in issue_labels:
-                labels_to_remove.append(label)
-
-        for label in labels_to_remove:
-            log.info(u"Added '%s' to issue #%d" % (label, issue_number))
-            issue.remove_from_labels(label.encode('utf-8'))
-        for label in labels_to_add:
-            log.info(u"Removed '%s' from issue #%d" % (label, issue_number))
-            issue.add_to_labels(label.encode('utf-8'))
+    # Keep the board of our scripts current.
+    if 'project_card' in payload:
+        get_board_index().apply_event(payload)
+
+    if payload.get('action') == 'moved':
+        card = payload['project_card']
+        # A card moved again before the worker got to it is updated once,
+        # to its latest column.
+        get_job_queue().enqueue(LABELLIZE_JOB, card['id'], {
+            'id': card['id'],
+            'column_id': card['column_id'],
+            'content_url': card.get('content_url'),
+        })
+        start_job_worker()
+        return '', 202
 
     return ''
 
@@ -289,6 +390,32 @@ def create_issue(language, video):
     return "<pre>%s</pre>" % out_raw
 
 
+# The routes below are for us only. Sign their path with our secret, eg.
+# path=/quota ; curl -H "X-Hub-Signature: sha1=$(printf $path \
+#   | openssl sha1 -hmac $(cat config/github-webhook-secret.txt) \
+#   | sed 's/^.* //')" https://bot.insoumis.online$path
+
+@app.route('/quota')
+def quota():
+    """
+    How much of the YouTube API quota our scripts spent today, per endpoint.
+    """
+    check_signature(request.path.encode('utf-8'))
+    return jsonify(get_quota_ledger().usage())
+
+
+@app.route('/github')
+def github():
+    """
+    How many requests to the GitHub API this process made, per endpoint,
+    and how many we have left.
+    The counters are those of the process answering the request only : each
+    process of the bot keeps its own, and they start over when it restarts.
+    """
+    check_signature(request.path.encode('utf-8'))
+    return jsonify(get_github_client().stats())
+
+
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory(